@@ -0,0 +1,249 @@
+import asyncio
+import fcntl
+import hashlib
+import importlib
+import os
+import sys
+import threading
+import time
+import traceback
+import uuid
+from datetime import datetime
+
+# Single-instance lock for the daemon
+AGENT_LOCK_FILE = "/var/run/agent.lock"
+
+AGENT_DIR = os.path.dirname(os.path.abspath(__file__))
+IN_BUNDLE = os.path.isfile(AGENT_DIR)
+if IN_BUNDLE:
+    # Imported from the agent.pyz bundle: files live next to the bundle
+    AGENT_DIR = os.path.dirname(AGENT_DIR)
+
+# Optional single-file deployment of the whole agent (see update_checker.build_bundle)
+BUNDLE_PATH = os.path.join(AGENT_DIR, "agent.pyz")
+# Create this file to deploy and run the agent from the bundle instead of loose files
+BUNDLE_FLAG = os.path.join(AGENT_DIR, "agent.bundle")
+
+# (minute, hour, job) in crontab notation; update_checker builds the fallback crontab from it
+SCHEDULE = [
+    ("*/2", "*", "led_status"),
+    ("*/5", "*", "online"),
+    ("0", "*/11", "validate_router"),
+    ("0", "*/5", "get_server_address"),
+    ("0", "*/2", "get_new_v2ray"),
+    ("0", "*/7", "update_checker"),
+    ("0", "*/9", "file_get"),
+    ("0", "*/1", "run_command"),
+    ("*/5", "*", "change_link"),
+    ("0", "*", "command_listener"),
+]
+
+# Jobs whose main() takes the shared ApiClient
+API_JOBS = {"online", "validate_router", "get_new_v2ray", "update_checker", "file_get", "run_command", "command_listener"}
+
+# Jobs that run until told to stop; main() also takes the agent's stop event
+LISTENER_JOBS = {"command_listener"}
+
+# Shared API client, rebuilt when get_server_address changes the server location
+_client = None
+
+
+def field_matches(field, value):
+    if field == "*":
+        return True
+    if field.startswith("*/"):
+        return value % int(field[2:]) == 0
+    return value == int(field)
+
+
+def schedule_seed():
+    """Stable per-device value the schedule offsets are derived from: the serial number."""
+    from identity import read_serial_numbers_from_file
+
+    serial_number, _ = read_serial_numbers_from_file()
+    # Before the serials are stored, fall back to the MAC address, which is just as stable
+    return serial_number or f"{uuid.getnode():012x}"
+
+
+def job_offset(seed, job, minute):
+    """Seconds this device runs job after its nominal time, spread over one period.
+
+    Jobs every n minutes are spread over n minutes; hourly-or-slower jobs over the hour, so
+    they still run in the hours the schedule names. The offset is the same on every run.
+    """
+    period = int(minute[2:]) * 60 if minute.startswith("*/") else 3600
+    digest = hashlib.sha256(f"{seed}:{job}".encode()).digest()
+    return int.from_bytes(digest[:4], "big") % period
+
+
+def job_offsets(seed):
+    return {job: job_offset(seed, job, minute) for minute, hour, job in SCHEDULE}
+
+
+def next_run(minute, hour, offset, after):
+    """First time after `after` (epoch seconds) when the job is due, shifted by offset."""
+    start = (int(after - offset) // 60 + 1) * 60
+    for nominal in range(start, start + 48 * 3600, 60):
+        local = datetime.fromtimestamp(nominal)
+        if field_matches(minute, local.minute) and field_matches(hour, local.hour):
+            return nominal + offset
+    return None
+
+
+def shared_client():
+    """Shared ApiClient for the current server location, None while there is none.
+
+    Called as each job starts. Without a client a job builds its own when it needs one:
+    update_checker still updates the code and recreates the server location first.
+    """
+    global _client
+    from api_client import ApiClient, read_server_url
+
+    server_url = read_server_url()
+    if server_url is None:
+        print("[!] Server location file not found or invalid. Jobs run without the shared client.")
+        return None
+    if _client is None or _client.server_url != server_url:
+        _client = ApiClient(server_url)
+    return _client
+
+
+def preload_jobs():
+    """Import every job module now; called when the daemon runs from the bundle.
+
+    update_checker replaces agent.pyz under the running daemon, and zipimport keeps reading
+    the old archive's directory: a module imported for the first time after that fails
+    ("bad local file header") until the restart. device_sync and change_link import job
+    modules only when they need them, so all of them are imported up front.
+    """
+    for job in dict.fromkeys(job for minute, hour, job in SCHEDULE):
+        try:
+            importlib.import_module(job)
+        except Exception as e:
+            print(f"[!] Could not import job {job}: {e}")
+
+
+def run_python_job(job, stop=None):
+    """Run <job>.main() in this process; SystemExit from the scripts only ends the job."""
+    started = time.monotonic()
+    try:
+        module = importlib.import_module(job)
+        if job in LISTENER_JOBS:
+            module.main(shared_client(), stop=stop)
+        elif job in API_JOBS:
+            module.main(shared_client())
+        else:
+            module.main()
+    except SystemExit:
+        pass
+    except Exception:
+        print(f"[!] Job {job} failed:")
+        traceback.print_exc()
+    print(f"[*] Job {job} finished in {time.monotonic() - started:.1f}s")
+
+
+def bundle_enabled():
+    return os.path.exists(BUNDLE_FLAG) and os.path.exists(BUNDLE_PATH)
+
+
+def job_command(job):
+    """Command line that runs one job (or "agent", the daemon) in its own interpreter."""
+    if bundle_enabled():
+        return [sys.executable, BUNDLE_PATH, job]
+    return [sys.executable, os.path.join(AGENT_DIR, f"{job}.py")]
+
+
+def source_mtimes():
+    mtimes = {}
+    for name in os.listdir(AGENT_DIR):
+        if name.endswith((".py", ".pyz")):
+            try:
+                mtimes[name] = os.path.getmtime(os.path.join(AGENT_DIR, name))
+            except OSError:
+                pass
+    return mtimes
+
+
+class Agent:
+    def __init__(self):
+        self.running = {}
+        self.mtimes = source_mtimes()
+        self.restart = False
+        # Set when the agent restarts, so listener jobs return
+        self.stopping = threading.Event()
+        self.offsets = job_offsets(schedule_seed())
+        self.plan(time.time())
+
+    def plan(self, now):
+        self.next_runs = {job: next_run(minute, hour, self.offsets[job], now) for minute, hour, job in SCHEDULE}
+
+    async def run_job(self, job):
+        print(f"[*] Starting job {job} at {datetime.now()}")
+        await asyncio.get_running_loop().run_in_executor(None, run_python_job, job, self.stopping)
+
+        # update_checker replaced our own code: restart once the other jobs are done
+        if job == "update_checker" and source_mtimes() != self.mtimes:
+            print("[*] Agent files were updated. Restarting after running jobs finish...")
+            self.restart = True
+            self.stopping.set()
+
+    def start(self, job):
+        # Never overlap two runs of the same job
+        task = self.running.get(job)
+        if task and not task.done():
+            print(f"[!] Job {job} is still running. Skipping this run.")
+            return
+        self.running[job] = asyncio.ensure_future(self.run_job(job))
+
+    async def run(self):
+        clock = (time.time(), time.monotonic())
+        while not self.restart:
+            now = time.time()
+            if abs((now - clock[0]) - (time.monotonic() - clock[1])) > 30:
+                # The wall clock jumped (NTP sync after boot): plan from the new time instead
+                # of running every job at once or none for hours
+                print("[*] System clock changed. Rescheduling jobs...")
+                self.plan(now)
+            clock = (now, time.monotonic())
+            for minute, hour, job in SCHEDULE:
+                if self.next_runs[job] <= now:
+                    self.start(job)
+                    self.next_runs[job] = next_run(minute, hour, self.offsets[job], now)
+
+            # Sleep until the next job is due (at least once a minute, to notice clock changes)
+            await asyncio.sleep(min(60, max(0, min(self.next_runs.values()) - time.time())))
+
+        await asyncio.gather(*self.running.values(), return_exceptions=True)
+
+
+def acquire_lock():
+    lock_file = open(AGENT_LOCK_FILE, "w")
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        print("Agent is already running. Exiting.")
+        exit()
+    return lock_file
+
+
+def main():
+    lock_file = acquire_lock()
+    # cron pipes the output to syslog: print each line as it is written
+    sys.stdout.reconfigure(line_buffering=True)
+    os.chdir(AGENT_DIR)
+    if not IN_BUNDLE and AGENT_DIR not in sys.path:
+        sys.path.insert(0, AGENT_DIR)
+    if IN_BUNDLE:
+        preload_jobs()
+
+    agent = Agent()
+    asyncio.run(agent.run())
+
+    # Replace this process with the updated code (switching to or from the bundle if needed)
+    lock_file.close()
+    command = job_command("agent")
+    os.execv(command[0], command)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,621 @@
+import base64
+import codecs
+import datetime
+import itertools
+import json
+import os
+import random
+import threading
+import time
+import http_transport
+from identity import forget_device_id, load_device_id, save_device_id
+
+# File path for storing server location
+SERVER_LOCATION_FILE = "/root/server_location.txt"
+
+# File path for the cached JWT access/refresh tokens
+TOKEN_CACHE_FILE = "/root/token_cache.json"
+
+# File path for the ETag / Last-Modified validators of polled resources
+VALIDATOR_CACHE_FILE = "/root/http_validators.json"
+
+# Renew the access token this many seconds before it expires
+TOKEN_EXPIRY_MARGIN = 60
+
+# (connect, read) timeouts in seconds for each API endpoint
+ENDPOINT_TIMEOUTS = {
+    "token": (5, 15),
+    "token-refresh": (5, 15),
+    "devices": (5, 15),
+    "device-online": (5, 10),
+    "device-update": (5, 10),
+    "device-sync": (5, 30),
+    "device-batch": (5, 30),
+    "device-v2ray": (5, 15),
+    "server-list": (5, 15),
+    "node-latency": (5, 10),
+    "device-file": (5, 30),
+    "device-command": (5, 30),
+}
+DEFAULT_TIMEOUT = (5, 30)
+
+# Upper bound on open connections to any one host; further requests wait for a free one,
+# for up to POOL_TIMEOUT seconds (requests: only this many are kept alive, none wait)
+MAX_CONNECTIONS_PER_HOST = 4
+POOL_TIMEOUT = 60
+
+# Create this file to send every request through the requests library instead of the
+# stdlib http_transport, which avoids importing requests (urllib3, idna, certifi...) per run
+REQUESTS_TRANSPORT_FLAG = "/root/http_transport.requests"
+USE_REQUESTS = os.path.exists(REQUESTS_TRANSPORT_FLAG)
+
+# Raised by the selected transport for connection errors, timeouts and raise_for_status()
+if USE_REQUESTS:
+    import requests
+    RequestException = requests.RequestException
+else:
+    RequestException = http_transport.RequestException
+
+# Local copy of a device list endpoint synced through the server's change cursor:
+# {"server": ..., "cursor": ..., "rows": {id: row}} with only the rows still pending
+LIST_SYNC_PATH = "/root/{name}_sync.json"
+
+# Rows per page asked from list endpoints that support cursors
+LIST_PAGE_SIZE = 100
+
+# Chunk size for reading streamed JSON bodies
+JSON_CHUNK_SIZE = 64 * 1024
+
+# Retry delays are spread by up to this fraction either way, so routers that failed
+# together (a server outage) do not all retry in the same second
+RETRY_JITTER = 0.5
+
+# Shared keep-alive session, created on first use
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_session():
+    """Return the process-wide keep-alive session of the selected transport."""
+    global _session
+    with _session_lock:
+        if _session is None:
+            if USE_REQUESTS:
+                from requests.adapters import HTTPAdapter
+
+                _session = requests.Session()
+                # No pool_block: urllib3 would wait for a free connection without a timeout
+                adapter = HTTPAdapter(pool_connections=4, pool_maxsize=MAX_CONNECTIONS_PER_HOST)
+                _session.mount("http://", adapter)
+                _session.mount("https://", adapter)
+            else:
+                _session = http_transport.Session(pool_maxsize=MAX_CONNECTIONS_PER_HOST, pool_timeout=POOL_TIMEOUT)
+    return _session
+
+
+def jittered(delay):
+    """Return delay randomly scaled within [1 - RETRY_JITTER, 1 + RETRY_JITTER]."""
+    return delay * random.uniform(1 - RETRY_JITTER, 1 + RETRY_JITTER)
+
+
+# Function to read the server base URL from the file, None if it is missing or empty
+def read_server_url():
+    if os.path.exists(SERVER_LOCATION_FILE):
+        try:
+            with open(SERVER_LOCATION_FILE, 'r') as file:
+                server_url = file.readline().strip()
+                if server_url:  # Ensure the URL is not empty
+                    return server_url.rstrip('/')
+        except Exception as e:
+            print(f"Error reading server location file: {e}")
+    return None
+
+
+# Function to read the server base URL from the file, exiting without one
+def get_server_url():
+    server_url = read_server_url()
+    if server_url is None:
+        print("Server location file not found or invalid. Exiting.")
+        exit()
+    return server_url
+
+
+# Decode the "exp" claim of a JWT without verifying it
+def jwt_expiry(token):
+    try:
+        payload = token.split(".")[1]
+        payload += "=" * (-len(payload) % 4)
+        return json.loads(base64.urlsafe_b64decode(payload)).get("exp")
+    except Exception:
+        return None
+
+
+class TokenCache:
+    """Access and refresh tokens persisted across runs, with hit/renewal counters.
+
+    The file is only written when the tokens change; counters are saved along with them.
+    """
+
+    def __init__(self, path=TOKEN_CACHE_FILE):
+        self.path = path
+        self.data = self.load()
+
+    def load(self):
+        try:
+            with open(self.path, "r") as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return {}
+
+    def save(self):
+        try:
+            temp_path = self.path + ".tmp"
+            with open(temp_path, "w") as file:
+                json.dump(self.data, file)
+            os.chmod(temp_path, 0o600)
+            os.replace(temp_path, self.path)
+        except OSError as e:
+            print(f"Error writing token cache: {e}")
+
+    def matches(self, server_url, username):
+        return self.data.get("server") == server_url and self.data.get("username") == username
+
+    def valid(self, kind):
+        """Return the cached "access" or "refresh" token if it is not about to expire."""
+        token = self.data.get(kind)
+        expiry = self.data.get(f"{kind}_exp")
+        if token and expiry and expiry - TOKEN_EXPIRY_MARGIN > time.time():
+            return token
+        return None
+
+    def store(self, server_url, username, access, refresh=None):
+        if self.data.get("server") != server_url or self.data.get("username") != username:
+            self.data = {"server": server_url, "username": username}
+        self.data["access"] = access
+        self.data["access_exp"] = jwt_expiry(access)
+        if refresh:
+            self.data["refresh"] = refresh
+            self.data["refresh_exp"] = jwt_expiry(refresh)
+        self.save()
+
+    def drop_access(self):
+        self.data.pop("access", None)
+        self.data.pop("access_exp", None)
+        self.save()
+
+    def count(self, counter):
+        self.data[counter] = self.data.get(counter, 0) + 1
+
+    def stats(self):
+        return {counter: self.data.get(counter, 0) for counter in ("hits", "renewals", "logins")}
+
+
+class ValidatorCache:
+    """ETag and Last-Modified per URL, sent back as conditional request headers.
+
+    Callers add headers(url) to a GET and call remember(url, response) only once they have
+    fully handled the response, so a failed run never turns the next poll into a 304.
+    A validator remembered with the sha256 of the stored copy is only sent while that copy
+    still has it (headers(url, sha256)), so a 304 never stands for a file changed since.
+    """
+
+    def __init__(self, path=VALIDATOR_CACHE_FILE):
+        self.path = path
+        self.lock = threading.Lock()
+        try:
+            with open(self.path, "r") as file:
+                self.validators = json.load(file)
+        except (OSError, ValueError):
+            self.validators = {}
+
+    def stored_hash(self, url):
+        return self.validators.get(url, {}).get("sha256")
+
+    def headers(self, url, sha256=None):
+        validator = self.validators.get(url, {})
+        headers = {}
+        if validator.get("sha256") != sha256:
+            return headers
+        if validator.get("etag"):
+            headers["If-None-Match"] = validator["etag"]
+        if validator.get("last_modified"):
+            headers["If-Modified-Since"] = validator["last_modified"]
+        return headers
+
+    def remember(self, url, response, sha256=None):
+        if response.status_code == 304:
+            return
+        validator = {
+            "etag": response.headers.get("ETag"),
+            "last_modified": response.headers.get("Last-Modified"),
+        }
+        if sha256:
+            validator["sha256"] = sha256
+        with self.lock:
+            if validator.get("etag") or validator.get("last_modified"):
+                self.validators[url] = validator
+            else:
+                self.validators.pop(url, None)
+            self.save()
+
+    def forget(self, url):
+        with self.lock:
+            if self.validators.pop(url, None) is not None:
+                self.save()
+
+    def save(self):
+        try:
+            temp_path = self.path + ".tmp"
+            with open(temp_path, "w") as file:
+                json.dump(self.validators, file)
+            os.replace(temp_path, self.path)
+        except OSError as e:
+            print(f"Error writing validator cache: {e}")
+
+
+def iter_json_array(chunks):
+    """Yield the elements of a top-level JSON array read from an iterable of byte chunks.
+
+    Elements are decoded one at a time as their bytes arrive, so the first one is available
+    before the body is complete and memory use is bounded by the largest element, not by the
+    length of the array. Raises ValueError for anything but a well-formed array.
+    """
+    decoder = json.JSONDecoder()
+    text = codecs.getincrementaldecoder("utf-8")()
+    chunks = iter(chunks)
+    buffer, position, eof = "", 0, False
+    expect = "["
+
+    while True:
+        while position < len(buffer) and buffer[position] in " \t\r\n":
+            position += 1
+        value = end = None
+        if position < len(buffer) and expect == "value":
+            try:
+                value, end = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+            else:
+                # Only accept a value once the "," or "]" after it has arrived: a number
+                # cut off by the chunk boundary decodes fine but wrongly
+                after = end
+                while after < len(buffer) and buffer[after] in " \t\r\n":
+                    after += 1
+                if not eof and (after == len(buffer) or buffer[after] not in ",]"):
+                    end = None
+
+        if position == len(buffer) or (expect == "value" and end is None):
+            if eof:
+                raise ValueError("Unexpected end of JSON array")
+            chunk = next(chunks, None)
+            eof = chunk is None
+            buffer = buffer[position:] + text.decode(chunk or b"", final=eof)
+            position = 0
+            continue
+
+        char = buffer[position]
+        if expect == "value":
+            position = end
+            expect = ","
+            yield value
+        elif expect == "[":
+            if char != "[":
+                raise ValueError("Expected a JSON array")
+            position += 1
+            expect = "first"
+        elif char == "]":
+            if expect == "first" or expect == ",":
+                return
+            raise ValueError(f"Unexpected ']' at character {position}")
+        elif expect == ",":
+            if char != ",":
+                raise ValueError(f"Expected ',' or ']' at character {position}")
+            position += 1
+            expect = "value"
+        else:
+            # First element
+            expect = "value"
+
+
+class IncrementalList:
+    """Pending rows of device-command or device-file, synced by the server's change cursor.
+
+    A cursor-capable server answers ?cursor=<c>&limit=<n> with
+    {"results": [...], "next": <url or null>, "cursor": <c>}: the rows changed since the
+    cursor, in pages. The first request (empty cursor, pending=1) asks for the pending rows
+    only. Rows that are done or expired are dropped and the rest are kept here, so history
+    is never downloaded and unchanged rows only once. A server without cursors ignores the
+    parameters and returns its plain list, which is used as it is; one that pages by limit
+    alone (DRF's LimitOffsetPagination: pages without "cursor") has all its pages read and
+    the pending rows used, with no cursor stored.
+    """
+
+    def __init__(self, endpoint, done_field, valid_field):
+        self.endpoint = endpoint
+        self.done_field = done_field
+        self.valid_field = valid_field
+        self.path = LIST_SYNC_PATH.format(name=endpoint.replace("-", "_"))
+        try:
+            with open(self.path, "r") as file:
+                self.state = json.load(file)
+        except (OSError, ValueError):
+            self.state = {}
+
+    def save(self):
+        try:
+            temp_path = self.path + ".tmp"
+            with open(temp_path, "w") as file:
+                json.dump(self.state, file)
+            os.replace(temp_path, self.path)
+        except OSError as e:
+            print(f"Error writing {self.endpoint} sync state: {e}")
+
+    def cursor(self, server_url):
+        """Cursor to send, "" when starting over (no state or another server)."""
+        if self.state.get("server") != server_url:
+            return ""
+        return self.state.get("cursor") or ""
+
+    def pending(self, row):
+        # Dates are ISO "YYYY-MM-DD", so comparing the strings compares the dates
+        return not row.get(self.done_field) and (row.get(self.valid_field) or "") >= datetime.date.today().isoformat()
+
+    def merge(self, server_url, rows, cursor):
+        """Apply changed rows and the new cursor; return every row still pending."""
+        stored = self.state.get("rows", {}) if self.state.get("server") == server_url else {}
+        for row in rows:
+            stored[str(row["id"])] = row
+        self.state = {
+            "server": server_url,
+            "cursor": cursor,
+            "rows": {row_id: row for row_id, row in stored.items() if self.pending(row)},
+        }
+        self.save()
+        return list(self.state["rows"].values())
+
+    def stream_pending(self, chunks, response):
+        """Pending rows of a plain list body, parsed one at a time; errors end the list.
+        The response is closed once the list ends."""
+        try:
+            for row in iter_json_array(chunks):
+                if self.pending(row):
+                    yield row
+        except (RequestException, ValueError) as e:
+            print(f"Error reading {self.endpoint} list: {e}")
+        finally:
+            response.close()
+
+    def fetch(self, client, wait=None):
+        """Return (rows, response to the first request); wait makes it a long-poll.
+
+        rows is a list, or for a server without cursors a generator over its plain list, so
+        a long history is streamed and filtered without ever being held in memory.
+        """
+        cursor = self.cursor(client.server_url)
+        params = {"cursor": cursor, "limit": LIST_PAGE_SIZE}
+        if not cursor:
+            params["pending"] = 1
+        first = response = client.list_page(self.endpoint, params=params, wait=wait, stream=True)
+        try:
+            response.raise_for_status()
+
+            # A page object or a plain list: look at the first non-blank character
+            chunks = response.iter_content(JSON_CHUNK_SIZE)
+            head = b""
+            for chunk in chunks:
+                head += chunk
+                if head.strip():
+                    break
+            if head.lstrip()[:1] == b"[":
+                return self.stream_pending(itertools.chain([head], chunks), response), first
+            data = json.loads(head + b"".join(chunks))
+        except BaseException:
+            # Unread or partly read: give the connection back to the pool
+            response.close()
+            raise
+
+        rows = list(data["results"])
+        while data.get("next"):
+            response = client.list_page(self.endpoint, page_url=data["next"])
+            response.raise_for_status()
+            data = response.json()
+            rows.extend(data["results"])
+        if "cursor" not in data:
+            return [row for row in rows if self.pending(row)], first
+        # The cursor only moves once every page arrived
+        return self.merge(client.server_url, rows, data["cursor"]), first
+
+
+def device_command_list():
+    return IncrementalList("device-command", "command_has_been_applied", "command_valid_until")
+
+
+def device_file_list():
+    return IncrementalList("device-file", "file_has_been_updated", "file_valid_until")
+
+
+class ApiClient:
+    """Thin wrapper around the shared session for the device API."""
+
+    def __init__(self, server_url=None):
+        self.server_url = (server_url or get_server_url()).rstrip('/')
+        self.session = get_session()
+        self.access_token = None
+        self.credentials = None
+        self.token_cache = TokenCache()
+        # Jobs of the agent daemon share one client from several threads
+        self.auth_lock = threading.RLock()
+
+    def url(self, path):
+        if path.startswith(self.server_url + "/"):
+            return path  # Absolute link from the server, e.g. the next page
+        return f"{self.server_url}/api/{path}"
+
+    def auth_headers(self):
+        if self.access_token:
+            return {"Authorization": f"Bearer {self.access_token}"}
+        return {}
+
+    def request(self, method, endpoint, path=None, with_token=True, **kwargs):
+        """Send a request to /api/<path>, using the timeout configured for the endpoint.
+        with_token=False leaves out the access token (for the token requests themselves)."""
+        headers = self.auth_headers() if with_token else {}
+        headers.update(kwargs.pop("headers", None) or {})
+        kwargs.setdefault("timeout", ENDPOINT_TIMEOUTS.get(endpoint, DEFAULT_TIMEOUT))
+        response = self.session.request(method, self.url(path or f"{endpoint}/"), headers=headers, **kwargs)
+
+        # A cached token the server no longer accepts: replace it and retry once
+        if response.status_code == 401 and self.credentials and "Authorization" in headers:
+            if self.reauthenticate(headers["Authorization"]):
+                headers.update(self.auth_headers())
+                response = self.session.request(method, self.url(path or f"{endpoint}/"), headers=headers, **kwargs)
+        return response
+
+    def reauthenticate(self, rejected):
+        """Replace the access token sent in the rejected Authorization header; True if there is
+        a new one. Threads that got the same 401 wait here and reuse the first one's token."""
+        with self.auth_lock:
+            if self.auth_headers().get("Authorization") != rejected:
+                return self.access_token is not None
+            self.token_cache.drop_access()
+            return self._authenticate(*self.credentials) is not None
+
+    # Password login; the new tokens are written to the shared cache
+    def token(self, username, password):
+        self.credentials = (username, password)
+        response = self.request("POST", "token", with_token=False, data={"username": username, "password": password})
+        if response.status_code == 200:
+            token_data = response.json()
+            self.access_token = token_data.get("access")
+            self.token_cache.count("logins")
+            self.token_cache.store(self.server_url, username, self.access_token, token_data.get("refresh"))
+        return response
+
+    def refresh_token(self, refresh):
+        return self.request("POST", "token-refresh", "token/refresh/", with_token=False, data={"refresh": refresh})
+
+    def get_token(self, username, password):
+        """authenticate(), but a connection error is printed and returns None."""
+        try:
+            return self.authenticate(username, password)
+        except RequestException as e:
+            print(f"Error obtaining token: {e}")
+            return None
+
+    def authenticate(self, username, password):
+        """Return an access token: cached if still valid, renewed via the refresh token,
+        or from a password login when there is no refresh token or it was rejected (401)."""
+        with self.auth_lock:
+            return self._authenticate(username, password)
+
+    def _authenticate(self, username, password):
+        self.credentials = (username, password)
+        cache = self.token_cache
+        if cache.matches(self.server_url, username):
+            access = cache.valid("access")
+            if access:
+                self.access_token = access
+                # Counted in memory; written with the next token change
+                cache.count("hits")
+                return access
+
+            refresh = cache.valid("refresh")
+            if refresh:
+                response = self.refresh_token(refresh)
+                if response.status_code == 200:
+                    token_data = response.json()
+                    self.access_token = token_data.get("access")
+                    cache.count("renewals")
+                    cache.store(self.server_url, username, self.access_token, token_data.get("refresh"))
+                    return self.access_token
+                if response.status_code != 401:
+                    print(f"Failed to renew token. Status code: {response.status_code}")
+                    self.access_token = None
+                    return None
+
+        response = self.token(username, password)
+        if response.status_code != 200:
+            print(f"Failed to obtain token. Status code: {response.status_code}")
+            self.access_token = None
+            return None
+        return self.access_token
+
+    def devices(self, serial_number):
+        return self.request("GET", "devices", params={"serial_number": serial_number})
+
+    def device_id(self, serial_number, refresh=False):
+        """Return the device id for serial_number, or None if the server does not know it.
+
+        The stored identity record is used unless refresh is set or it belongs to another
+        server; otherwise the id is looked up with one devices() call. A server error raises
+        (RequestException), so callers can retry or spool instead of giving up.
+        """
+        if refresh:
+            forget_device_id()
+        else:
+            device_id = load_device_id(serial_number, self.server_url)
+            if device_id is not None:
+                return device_id
+
+        response = self.devices(serial_number)
+        if response.status_code >= 500:
+            response.raise_for_status()
+        if response.status_code != 200:
+            print(f"Failed to fetch device. Status code: {response.status_code}")
+            return None
+        device_data = response.json()
+        if not device_data:
+            return None
+        device_id = device_data[0]["id"]
+        save_device_id(device_id, serial_number, self.server_url)
+        return device_id
+
+    def device_online(self, payload):
+        return self.request("POST", "device-online", json=payload)
+
+    def device_update(self, payload):
+        return self.request("POST", "device-update", json=payload)
+
+    def device_sync(self, payload):
+        return self.request("POST", "device-sync", json=payload)
+
+    def device_batch(self, payload):
+        return self.request("POST", "device-batch", json=payload)
+
+    def device_v2ray(self, validators=None, **kwargs):
+        headers = validators.headers(self.url("device-v2ray/")) if validators else None
+        return self.request("GET", "device-v2ray", headers=headers, **kwargs)
+
+    def server_list(self, server_list_id, validators=None):
+        path = f"server-list/{server_list_id}/"
+        headers = validators.headers(self.url(path)) if validators else None
+        return self.request("GET", "server-list", path, headers=headers)
+
+    def server_lists(self, server_list_ids, validators=None):
+        """GET several server lists in one request (?id__in=), on servers that support it."""
+        path = "server-list/?id__in=" + ",".join(str(server_list_id) for server_list_id in server_list_ids)
+        headers = validators.headers(self.url(path)) if validators else None
+        return self.request("GET", "server-list", path, headers=headers)
+
+    def node_latency(self, payload):
+        return self.request("POST", "node-latency", json=payload)
+
+    def device_file(self):
+        return self.request("GET", "device-file")
+
+    def update_device_file(self, file_id, data):
+        return self.request("PATCH", "device-file", f"device-file/{file_id}/", json=data)
+
+    def device_command(self):
+        return self.request("GET", "device-command")
+
+    def list_page(self, endpoint, params=None, page_url=None, wait=None, **kwargs):
+        """GET a page of a list endpoint; with wait, a long-poll held up to wait seconds."""
+        if wait is not None:
+            params = dict(params or {}, wait=wait)
+            kwargs["timeout"] = (ENDPOINT_TIMEOUTS.get(endpoint, DEFAULT_TIMEOUT)[0], wait + 15)
+        return self.request("GET", endpoint, page_url, params=params, **kwargs)
+
+    def update_device_command(self, command_id, data):
+        return self.request("PATCH", "device-command", f"device-command/{command_id}/", json=data)
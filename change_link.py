@@ -1,86 +1,101 @@
+import fcntl
+import json
+import os
 import time
-import subprocess
+from led_status import connectivity_status
 
-def detect_status_from_led():
-    try:
-        # Define paths to LED trigger files
-        red_path = "/sys/class/leds/LED0_Red/trigger"
-        green_path = "/sys/class/leds/LED0_Green/trigger"
-        blue_path = "/sys/class/leds/LED0_Blue/trigger"
-
-        # Read the content of each file
-        with open(red_path, 'r') as red_file:
-            red_status = red_file.read().strip()
-        with open(green_path, 'r') as green_file:
-            green_status = green_file.read().strip()
-        with open(blue_path, 'r') as blue_file:
-            blue_status = blue_file.read().strip()
-
-        # Check conditions for 'green-blue' (VPN connected)
-        if '[none]' in red_status and '[default-on]' in green_status and '[default-on]' in blue_status:
-            return "green-blue"
-
-        # Check conditions for 'green-red' (Internet connected, no VPN)
-        elif '[default-on]' in red_status and '[default-on]' in green_status and '[none]' in blue_status:
-            return "green-red"
-
-        else:
-            return "unknown"
+# Consecutive 'green-red' checks, kept between runs
+CHANGE_LINK_STATE_PATH = "/root/change_link_state.json"
+CHANGE_LINK_LOCK_FILE = "/var/run/change_link.lock"
 
-    except FileNotFoundError as e:
-        print(f"File not found: {e}")
-        return "error"
-    except Exception as e:
-        print(f"Unexpected error: {e}")
-        return "error"
+# 'green-red' checks in a row after which get_new_v2ray fetches a new link
+GREEN_RED_THRESHOLD = 3
 
+# Checks closer together than this count once; a gap longer than GREEN_RED_MAX_GAP (the
+# router was off, or the job did not run) starts the count again
+GREEN_RED_MIN_SPACING = 240
+GREEN_RED_MAX_GAP = 900
 
-# Retry logic with check for consecutive 'green-red' status
-def retry_request(func, max_retries=3, delay=300, consecutive_threshold=3):
-    consecutive_green_red = 0  # Counter for consecutive 'green-red' status
+# Seconds after a switch before the next one: when every node is down, passwall2 is not
+# restarted every few minutes. The checks keep counting meanwhile.
+SWITCH_MIN_INTERVAL = 1800
 
-    for attempt in range(max_retries):
-        response = func()
 
-        if response == "green-blue":
-            print("VPN connected. Resetting green-red counter.")
-            consecutive_green_red = 0  # Reset counter
-            return response
+def load_state():
+    try:
+        with open(CHANGE_LINK_STATE_PATH, 'r') as state_file:
+            return json.load(state_file)
+    except (OSError, ValueError):
+        return {}
 
-        elif response == "green-red":
-            consecutive_green_red += 1
-            print(f"'green-red' status detected {consecutive_green_red}/{consecutive_threshold} times.")
 
-            # Check if threshold is reached
-            if consecutive_green_red == consecutive_threshold:
-                print(f"'green-red' status detected {consecutive_threshold} times consecutively. Running get_new_v2ray.py...")
-                subprocess.run(["python", "get_new_v2ray.py"])
-                consecutive_green_red = 0  # Reset counter after running the script
-                exit()
+def save_state(state):
+    try:
+        with open(CHANGE_LINK_STATE_PATH + ".tmp", 'w') as state_file:
+            json.dump(state, state_file)
+        os.replace(CHANGE_LINK_STATE_PATH + ".tmp", CHANGE_LINK_STATE_PATH)
+    except OSError as e:
+        print(f"Error writing change_link state: {e}")
+
+
+# Failover decision: feed one status check into the state, return (new state, True when the
+# link should be changed). No I/O, so a scheduler loop can call it as often as it checks.
+def advance(state, status, now):
+    if status != "green-red":
+        if state.get("green_red"):
+            print(f"Status is '{status}'. Resetting green-red counter.")
+        return {key: state[key] for key in ("switched_at",) if key in state}, False
+
+    last_at = state.get("last_at", 0)
+    if now - last_at < GREEN_RED_MIN_SPACING:
+        # Checked again within the same interval: it counts once
+        return state, False
+    count = state.get("green_red", 0) + 1 if now - last_at <= GREEN_RED_MAX_GAP else 1
+    state = dict(state, green_red=count, last_at=now)
+    if count == 1:
+        state["first_at"] = now
+    print(f"'green-red' status detected {count}/{GREEN_RED_THRESHOLD} times.")
+
+    if count >= GREEN_RED_THRESHOLD:
+        since_switch = now - state.get("switched_at", now - SWITCH_MIN_INTERVAL)
+        if 0 <= since_switch < SWITCH_MIN_INTERVAL:
+            print(f"The link was changed {since_switch:.0f}s ago. Waiting before changing it again.")
+            return state, False
+        return {"switched_at": now}, True
+    return state, False
+
+
+def change_link():
+    print(f"'green-red' status detected {GREEN_RED_THRESHOLD} times consecutively. Running get_new_v2ray...")
+    # In this process, so it also works when running from the agent.pyz bundle
+    import get_new_v2ray
+    try:
+        # Rank the nodes again, preferring any healthy one over the current node
+        get_new_v2ray.main(avoid_current=True)
+    except SystemExit:
+        pass
 
-        elif response == "unknown":
-            print("Status is 'unknown'. Stopping retries.")
-            return "unknown"  # Exit immediately if the status is unknown
 
+def main():
+    # A run takes a moment; if one is still busy (fetching a new link), skip this check
+    lock_file = open(CHANGE_LINK_LOCK_FILE, 'w')
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        print("change_link is already running. Skipping.")
+        return
+
+    with lock_file:
+        state = load_state()
+        status = connectivity_status()
+        new_state, switch = advance(state, status, time.time())
+        if new_state != state:
+            save_state(new_state)
+        if switch:
+            change_link()
         else:
-            print(f"Error or unexpected status: {response}. Resetting green-red counter.")
-            consecutive_green_red = 0  # Reset counter
-
-        # Wait before retrying, unless it's the last attempt
-        if attempt < max_retries - 1:
-            print(f"Retry {attempt + 1}/{max_retries} failed. Retrying in {delay} seconds...")
-            time.sleep(delay)
-
-    print("Maximum retries reached.")
-    return "failed"
-
+            print(f"Detected status: {status}")
 
-# Execute with retries
-device_response = retry_request(detect_status_from_led)
 
-if device_response == "failed":
-    print("Failed to detect the LED status.")
-elif device_response == "unknown":
-    print("Stopping retries due to unknown status.")
-else:
-    print(f"Detected status: {device_response}")
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,35 @@
+import fcntl
+from api_client import ApiClient
+from identity import get_serial_numbers
+from run_command import listen
+
+# Only one listener per router, whether the agent or cron started it
+LISTENER_LOCK_FILE = "/var/run/command_listener.lock"
+
+
+# Wait for commands on a long-poll until stop is set (by the agent) or the server turns
+# out not to support it; scheduled hourly, so a listener that stopped is started again
+def main(client=None, stop=None):
+    lock_file = open(LISTENER_LOCK_FILE, "w")
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        print("Command listener is already running. Exiting.")
+        lock_file.close()
+        return
+
+    try:
+        client = client or ApiClient()
+
+        # Read the stored serial numbers, extracting them from the device on first run
+        serial_number, mlb_serial_number = get_serial_numbers()
+        if not serial_number or not mlb_serial_number:
+            return
+
+        listen(client, serial_number, mlb_serial_number, stop)
+    finally:
+        lock_file.close()
+
+
+if __name__ == "__main__":
+    main()
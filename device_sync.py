@@ -0,0 +1,103 @@
+import importlib
+import json
+import os
+import time
+import traceback
+from api_client import device_command_list, device_file_list
+
+# Result of the last device-sync call, read by the scripts the sync stands in for
+SYNC_STATE_PATH = "/root/device_sync.json"
+
+# Status codes of a server without the device-sync endpoint
+SYNC_UNSUPPORTED_CODES = (404, 405, 501)
+
+# After an unsupported answer, probe the endpoint again this many seconds later
+SYNC_RECHECK_INTERVAL = 3600
+
+# run_command, file_get, get_new_v2ray and validate_router skip their own calls while the
+# last successful sync is at most this old; if syncing stops they poll again by themselves
+SYNC_FRESHNESS = 15 * 60
+
+
+def load_state():
+    try:
+        with open(SYNC_STATE_PATH, "r") as state_file:
+            return json.load(state_file)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_state(state):
+    try:
+        temp_path = SYNC_STATE_PATH + ".tmp"
+        with open(temp_path, "w") as state_file:
+            json.dump(state, state_file)
+        os.replace(temp_path, SYNC_STATE_PATH)
+    except OSError as e:
+        print(f"Error writing sync state: {e}")
+
+
+def sync_supported():
+    """False for SYNC_RECHECK_INTERVAL after the server answered that it has no device-sync."""
+    return load_state().get("unsupported_at", 0) + SYNC_RECHECK_INTERVAL < time.time()
+
+
+def sync_recent():
+    """True while the per-endpoint polls are covered by a recent successful sync."""
+    return load_state().get("synced_at", 0) + SYNC_FRESHNESS > time.time()
+
+
+def mark_unsupported():
+    save_state({"unsupported_at": time.time()})
+
+
+def mark_synced(reply):
+    save_state({"synced_at": time.time(), "device_status": reply.get("device_status")})
+
+
+def mark_unchanged():
+    """The server confirmed it has nothing new since the last sync: keep that sync recent."""
+    state = load_state()
+    if "synced_at" in state:
+        state["synced_at"] = time.time()
+        save_state(state)
+
+
+# Run one handler, module.function; a failing handler (or import) must not keep the others
+# from running, nor the sync from being marked
+def run_handler(name, module, function, *args, **kwargs):
+    try:
+        getattr(importlib.import_module(module), function)(*args, **kwargs)
+    except SystemExit:
+        pass
+    except Exception:
+        print(f"[!] Sync handler {name} failed:")
+        traceback.print_exc()
+
+
+def sync_cursors(server_url):
+    """Change cursors of the command and file lists, sent with the sync heartbeat."""
+    return {"commands": device_command_list().cursor(server_url), "files": device_file_list().cursor(server_url)}
+
+
+def handle_sync(client, reply):
+    """Hand each part of a device-sync reply to the handler of the script it replaces."""
+    commands = reply.get("commands")
+    files = reply.get("files")
+    # With cursors the reply only holds the rows changed since the last sync
+    cursors = reply.get("cursors") or {}
+    if "commands" in cursors:
+        commands = device_command_list().merge(client.server_url, commands or [], cursors["commands"])
+    if "files" in cursors:
+        files = device_file_list().merge(client.server_url, files or [], cursors["files"])
+
+    # The handler modules are only imported when their part of the reply is present
+    if reply.get("device_status") is not None:
+        run_handler("device_status", "validate_router", "apply_device_status", reply["device_status"])
+    if commands:
+        run_handler("commands", "run_command", "apply_commands", client, commands)
+    if files:
+        run_handler("files", "file_get", "apply_files", client, files)
+    if reply.get("v2ray"):
+        run_handler("v2ray", "get_new_v2ray", "apply_synced_links", reply["v2ray"], client)
+    mark_synced(reply)
@@ -1,153 +1,141 @@
 from datetime import datetime
+import hashlib
 import os
-import requests
 import shutil
 import re
 import urllib.parse
 import subprocess
+from api_client import ApiClient, ValidatorCache, DEFAULT_TIMEOUT, RequestException, device_file_list
+from device_sync import sync_recent
+from identity import get_serial_numbers
+from upload_spool import retryable, spool_upload
 
-# File path for storing serial numbers
-SERIAL_FILE_PATH = "/root/serial_numbers.txt"
 
-# File path for storing server location
-SERVER_LOCATION_FILE = "/root/server_location.txt"
-
-
-# Step 1: Obtain the token
-def get_token(api_url, username, password):
-    token_endpoint = f"{api_url}/api/token/"
-    payload = {
-        "username": username,
-        "password": password
-    }
+# Step 1: Fetch the pending files
+def get_device_file(client):
     try:
-        response = requests.post(token_endpoint, data=payload)
-        response.raise_for_status()
-        token_data = response.json()
-        return token_data.get("access")  # Return the access token
-    except requests.exceptions.RequestException as e:
-        print(f"Error obtaining token: {e}")
+        rows, _ = device_file_list().fetch(client)
+        return rows
+    except (RequestException, ValueError, KeyError) as e:
+        print(f"Error fetching device-v2ray data: {e}")
         return None
 
 
-# Step 2: Fetch the device-v2ray information
-def get_device_file(api_url, token):
-    device_file_endpoint = f"{api_url}/api/device-file/"
-    headers = {
-        "Authorization": f"Bearer {token}"
-    }
+# Function to calculate the SHA256 of a local file, None if it cannot be read
+def file_hash(path):
+    sha256 = hashlib.sha256()
     try:
-        response = requests.get(device_file_endpoint, headers=headers)
-        response.raise_for_status()
-        return response.json()
-    except requests.exceptions.RequestException as e:
-        print(f"Error fetching device-v2ray data: {e}")
+        with open(path, 'rb') as file:
+            for chunk in iter(lambda: file.read(64 * 1024), b""):
+                sha256.update(chunk)
+        return sha256.hexdigest()
+    except OSError:
         return None
 
 
 # Function to update the database
-def update_database(api_url, token, file_id, destination_file):
+def update_database(client, file_id, destination_file):
     try:
-        update_endpoint = f"{api_url}/api/device-file/{file_id}/"
-        headers = {
-            "Authorization": f"Bearer {token}",
-            "Content-Type": "application/json"
-        }
         update_data = {
             "file_has_been_updated": True,
             "file_has_been_updated_time": datetime.now().isoformat()
         }
 
         # Send PATCH request to update the database
-        update_response = requests.patch(update_endpoint, headers=headers, json=update_data)
+        update_response = client.update_device_file(file_id, update_data)
         update_response.raise_for_status()  # Raise error if request fails
 
         print(f"Database updated for file: {destination_file}")
 
+    except RequestException as e:
+        print(f"Failed to update database: {e}")
+        if retryable(e):
+            spool_upload("file", update_data, file_id)
     except Exception as e:
         print(f"Failed to update database: {e}")
 
 
-# Function to read the server base URL from the file
-def get_base_url():
-    if os.path.exists(SERVER_LOCATION_FILE):
-        try:
-            with open(SERVER_LOCATION_FILE, 'r') as file:
-                base_url = file.readline().strip()
-                if base_url:  # Ensure the URL is not empty
-                    return base_url.rstrip('/') + '/'  # Ensure it ends with a slash
-        except Exception as e:
-            print(f"Error reading server location file: {e}")
-    print("Server location file not found or invalid. Exiting.")
-    exit()
-
-
-# Function to read serial numbers from file
-def read_serial_numbers_from_file():
-    if os.path.exists(SERIAL_FILE_PATH):
-        try:
-            with open(SERIAL_FILE_PATH, 'r') as file:
-                lines = file.readlines()
-                if len(lines) == 2:
-                    return lines[0].strip(), lines[1].strip()  # Return both serials
-        except Exception as e:
-            print(f"Error reading from file: {e}")
-    return None, None
+# Download, replace or remove the pending files (also called with device-sync replies)
+def apply_files(client, device_file_data):
+    validators = ValidatorCache()
+    for file in device_file_data:
+        current_date = datetime.now().date()
+        valid_until = datetime.strptime(file['file_valid_until'], '%Y-%m-%d').date()
+
+        # Check conditions
+        if file['file_status'] and valid_until >= current_date and not file['file_has_been_updated']:
+            destination_file = file['file_local_location']
+            source_file = file['file_remote_location']
+
+            if not source_file:
+                # Remove destination file if source file is empty
+                try:
+                    if os.path.exists(destination_file):
+                        os.remove(destination_file)
+                        print(f"Destination file removed: {destination_file}")
+                        update_database(client, file['id'], destination_file)
+                except Exception as e:
+                    print(f"An error occurred while removing file: {e}")
+            else:
+                try:
+                    # Download the file content, conditionally only while the destination still
+                    # holds what was downloaded from this URL: after a local edit, or for another
+                    # destination of the same URL, a 304 would leave the wrong content in place
+                    validator_key = f"{source_file} -> {destination_file}"
+                    local_hash = file_hash(destination_file) if validators.stored_hash(validator_key) else None
+                    headers = validators.headers(validator_key, local_hash) if local_hash else {}
+                    with client.session.get(source_file, headers=headers, stream=True, timeout=DEFAULT_TIMEOUT) as response:
+                        response.raise_for_status()  # Raise an error for bad status codes
+
+                        if response.status_code == 304:
+                            print(f"File unchanged, keeping: {destination_file}")
+                        else:
+                            # Ensure destination directory exists
+                            os.makedirs(os.path.dirname(destination_file), exist_ok=True)
+
+                            # Stream the content to a temp file and move it over the destination file
+                            temp_file = destination_file + ".tmp"
+                            sha256 = hashlib.sha256()
+                            with open(temp_file, 'wb') as output_file:  # Renamed 'file' to 'output_file'
+                                for chunk in response.iter_content(chunk_size=64 * 1024):
+                                    sha256.update(chunk)
+                                    output_file.write(chunk)
+                                output_file.flush()
+                                os.fsync(output_file.fileno())
+                            # Keep the mode of the file it replaces (a pushed script stays executable)
+                            if os.path.exists(destination_file):
+                                os.chmod(temp_file, os.stat(destination_file).st_mode & 0o7777)
+                            os.replace(temp_file, destination_file)
+
+                            print(f"File downloaded and saved to: {destination_file}")
+                            validators.remember(validator_key, response, sha256.hexdigest())
+                    update_database(client, file['id'], destination_file)
+
+                except Exception as e:
+                    print(f"An error occurred: {e}")
 
 
 # Main script execution
-if __name__ == "__main__":
-    api_url = get_base_url()
+def main(client=None):
+    if sync_recent():
+        print("File jobs are delivered by device-sync. Skipping.")
+        return
+
+    client = client or ApiClient()
 
-    # Extract serial numbers
-    serial_number, mlb_serial_number = read_serial_numbers_from_file()
+    # Read the stored serial numbers, extracting them from the device on first run
+    serial_number, mlb_serial_number = get_serial_numbers()
 
     username = serial_number
     password = mlb_serial_number
 
-    source_file = ''
-    destination_file = ''
-
-    token = get_token(api_url, username, password)
+    token = client.get_token(username, password)
     if token:
-        device_file_data = get_device_file(api_url, token)
-
-        for file in device_file_data:
-            current_date = datetime.now().date()
-            valid_until = datetime.strptime(file['file_valid_until'], '%Y-%m-%d').date()
-
-            # Check conditions
-            if file['file_status'] and valid_until >= current_date and not file['file_has_been_updated']:
-                destination_file = file['file_local_location']
-                source_file = file['file_remote_location']
-
-                if not source_file:
-                    # Remove destination file if source file is empty
-                    try:
-                        if os.path.exists(destination_file):
-                            os.remove(destination_file)
-                            print(f"Destination file removed: {destination_file}")
-                            update_database(api_url, token, file['id'], destination_file)
-                    except Exception as e:
-                        print(f"An error occurred while removing file: {e}")
-                else:
-                    try:
-                        # Download the file content directly
-                        response = requests.get(source_file)
-                        response.raise_for_status()  # Raise an error for bad status codes
-
-                        # Ensure destination directory exists
-                        os.makedirs(os.path.dirname(destination_file), exist_ok=True)
-
-                        # Write the content to the destination file
-                        with open(destination_file, 'wb') as output_file:  # Renamed 'file' to 'output_file'
-                            output_file.write(response.content)
-
-                        print(f"File downloaded and saved to: {destination_file}")
-                        update_database(api_url, token, file['id'], destination_file)
-
-                    except Exception as e:
-                        print(f"An error occurred: {e}")
-
+        device_file_data = get_device_file(client)
+        apply_files(client, device_file_data or [])
     else:
         print("Failed to obtain token.")
+
+
+if __name__ == "__main__":
+    main()
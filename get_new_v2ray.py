@@ -1,91 +1,216 @@
+import fcntl
+import json
 import os
-import requests
 import re
+import socket
+import ssl
+import time
 import urllib.parse
 import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from api_client import ApiClient, JSON_CHUNK_SIZE, RequestException, ValidatorCache, iter_json_array
+from device_sync import sync_recent
+from identity import get_serial_numbers, read_serial_numbers_from_file
+from uci import UciConfig
 
+PASSWALL2_CONFIG = "/etc/config/passwall2"
 
-# Extract serial numbers from the file
-def extract_serial_numbers(file_path):
-    try:
-        result = subprocess.run(["strings", file_path], capture_output=True, text=True)
-        if result.returncode != 0:
-            print("Failed to read the file.")
-            return None, None
+# Node written for the fastest link; the runners-up become '<PRIMARY_NODE>_b1', '_b2', ...
+PRIMARY_NODE = "lFQCkuzv"
+MAX_BACKUP_NODES = 4
 
-        mlb_match = re.search(r"mlb_serial_number\s+([A-Za-z0-9]+)", result.stdout)
-        serial_match = re.search(r"\bserial_number\s+([A-Za-z0-9]+)", result.stdout)
+# Seconds allowed for the TCP connect and TLS handshake of one candidate, and probes at once
+NODE_PROBE_TIMEOUT = 3
+NODE_PROBE_WORKERS = 8
 
-        mlb_serial_number = mlb_match.group(1) if mlb_match else None
-        serial_number = serial_match.group(1) if serial_match else None
+# The current node stays primary unless the fastest is this much faster, so passwall2 is
+# not restarted over latency noise
+NODE_SWITCH_MARGIN = 0.3
 
-        return mlb_serial_number, serial_number
+# device-sync delivers the links with every heartbeat; they are only probed (and the
+# latencies reported) again when they changed or after this many seconds, the interval of
+# the get_new_v2ray job
+RANK_INTERVAL = 7200
 
-    except Exception as e:
-        print(f"Error extracting serial numbers: {e}")
-        return None, None
+# Server lists fetched at once on servers without ?id__in= (api_client also caps each host)
+SERVER_LIST_WORKERS = 4
 
+# Status codes of a server without ?id__in=; it is asked again after BULK_RECHECK_INTERVAL
+BULK_UNSUPPORTED_CODES = (400, 404, 405, 501)
+BULK_RECHECK_INTERVAL = 86400
 
-# Step 1: Obtain the token
-def get_token(api_url, username, password):
-    token_endpoint = f"{api_url}/api/token/"
-    payload = {
-        "username": username,
-        "password": password
-    }
+
+# Read the stored device-v2ray list one item at a time
+def read_device_v2ray():
     try:
-        response = requests.post(token_endpoint, data=payload)
-        response.raise_for_status()
-        token_data = response.json()
-        return token_data.get("access")  # Return the access token
-    except requests.exceptions.RequestException as e:
-        print(f"Error obtaining token: {e}")
-        return None
+        with open(LOCAL_DEVICE_V2RAY_FILE, 'rb') as file:
+            yield from iter_json_array(iter(lambda: file.read(JSON_CHUNK_SIZE), b""))
+    except (OSError, ValueError) as e:
+        print(f"Error reading stored device-v2ray data: {e}")
 
 
-# Step 2: Fetch the device-v2ray information
-def get_device_v2ray(api_url, token):
-    device_v2ray_endpoint = f"{api_url}/api/device-v2ray/"
-    headers = {
-        "Authorization": f"Bearer {token}"
-    }
+# Step 1: Fetch the device-v2ray information (conditional, reusing the stored copy on 304).
+# The body is streamed to the stored copy and its items are parsed from there one at a time.
+def get_device_v2ray(client, validators):
+    url = client.url("device-v2ray/")
     try:
-        response = requests.get(device_v2ray_endpoint, headers=headers)
-        response.raise_for_status()
-        return response.json()
-    except requests.exceptions.RequestException as e:
+        response = client.device_v2ray(validators, stream=True)
+        if response.status_code == 304:
+            response.close()
+            if os.path.exists(LOCAL_DEVICE_V2RAY_FILE):
+                return read_device_v2ray()
+            # Stored copy is gone: fetch the full list again
+            validators.forget(url)
+            response = client.device_v2ray(validators, stream=True)
+        with response:
+            response.raise_for_status()
+            with open(LOCAL_DEVICE_V2RAY_FILE + ".tmp", 'wb') as file:
+                for chunk in response.iter_content(JSON_CHUNK_SIZE):
+                    file.write(chunk)
+        os.replace(LOCAL_DEVICE_V2RAY_FILE + ".tmp", LOCAL_DEVICE_V2RAY_FILE)
+        validators.remember(url, response)
+        return read_device_v2ray()
+    except (RequestException, OSError) as e:
         print(f"Error fetching device-v2ray data: {e}")
         return None
 
 
-# Step 3: Fetch the server_list data by ID
-def get_server_list(api_url, token, server_list_id):
-    server_list_endpoint = f"{api_url}/api/server-list/{server_list_id}/"
-    headers = {
-        "Authorization": f"Bearer {token}"
-    }
+# Step 2: Fetch the link of one server list (conditional; 304 means the stored link is current)
+def get_server_list(client, server_list_id, validators, stored):
+    url = client.url(f"server-list/{server_list_id}/")
     try:
-        response = requests.get(server_list_endpoint, headers=headers)
+        response = client.server_list(server_list_id, validators)
+        if response.status_code == 304:
+            if str(server_list_id) in stored:
+                return stored[str(server_list_id)]
+            # Stored link is gone: fetch the server list again
+            validators.forget(url)
+            response = client.server_list(server_list_id, validators)
         response.raise_for_status()
-        return response.json()
-    except requests.exceptions.RequestException as e:
+        vless_link = response.json().get("v2ray_link")
+        validators.remember(url, response)
+        return vless_link
+    except (RequestException, ValueError) as e:
         print(f"Error fetching server-list data for ID {server_list_id}: {e}")
         return None
 
 
+# Fetch the links of several server lists in one ?id__in= request. Returns {id: link} for
+# the ids in the reply, or None when the server does not support the filter.
+def get_server_lists_bulk(client, server_list_ids, validators, stored):
+    url = client.url("server-list/?id__in=" + ",".join(str(server_list_id) for server_list_id in server_list_ids))
+    wanted = {str(server_list_id) for server_list_id in server_list_ids}
+    try:
+        response = client.server_lists(server_list_ids, validators)
+        if response.status_code == 304:
+            if wanted <= set(stored):
+                return {server_list_id: stored[server_list_id] for server_list_id in wanted}
+            validators.forget(url)
+            response = client.server_lists(server_list_ids, validators)
+        if response.status_code in BULK_UNSUPPORTED_CODES:
+            return None
+        response.raise_for_status()
+        rows = response.json()
+    except (RequestException, ValueError) as e:
+        print(f"Error fetching server lists {sorted(wanted)}: {e}")
+        return {}
+
+    if isinstance(rows, dict):
+        rows = rows.get("results")
+    if not isinstance(rows, list) or any(str(row.get("id")) not in wanted for row in rows if isinstance(row, dict)):
+        # The filter was ignored (every list came back): fetch by ID from now on
+        return None
+    validators.remember(url, response)
+    return {str(row["id"]): row["v2ray_link"] for row in rows if isinstance(row, dict) and row.get("v2ray_link")}
+
+
+# Links of the given server lists, each ID fetched once: with one bulk request where the
+# server supports it, else with up to SERVER_LIST_WORKERS requests at a time
+def get_server_lists(client, server_list_ids, validators):
+    server_list_ids = list(dict.fromkeys(str(server_list_id) for server_list_id in server_list_ids))
+    state = load_server_list_state()
+    stored = state["links"]
+    links = {}
+    if len(server_list_ids) > 1 and state.get("bulk_unsupported_at", 0) + BULK_RECHECK_INTERVAL < time.time():
+        bulk = get_server_lists_bulk(client, server_list_ids, validators, stored)
+        if bulk is None:
+            state["bulk_unsupported_at"] = time.time()
+        else:
+            state.pop("bulk_unsupported_at", None)
+            links.update(bulk)
+
+    missing = [server_list_id for server_list_id in server_list_ids if server_list_id not in links]
+    if missing:
+        with ThreadPoolExecutor(max_workers=min(SERVER_LIST_WORKERS, len(missing))) as executor:
+            fetched = executor.map(lambda server_list_id: get_server_list(client, server_list_id, validators, stored), missing)
+            links.update((server_list_id, link) for server_list_id, link in zip(missing, fetched) if link)
+
+    stored.update(links)
+    save_server_list_state(state)
+    return links
+
+
+# Step 3: Report the measured node latencies (best effort: older servers answer 404)
+def report_node_latency(client, ranked):
+    serial_number, _ = read_serial_numbers_from_file()
+    payload = {
+        "serial_number": serial_number,
+        "nodes": [
+            {
+                "server_list": node["server_list"],
+                "address": node["fields"]["address"],
+                "port": int(node["fields"]["port"]),
+                "latency_ms": None if node["latency"] is None else round(node["latency"] * 1000),
+                "rank": node.get("rank"),
+            }
+            for node in ranked
+        ],
+    }
+    try:
+        response = client.node_latency(payload)
+        if response.status_code == 404:
+            print("Server does not collect node latencies.")
+        else:
+            response.raise_for_status()
+    except RequestException as e:
+        print(f"Error reporting node latencies: {e}")
+
+
+def load_server_list_state():
+    try:
+        with open(LOCAL_SERVER_LISTS_FILE, 'r') as file:
+            state = json.load(file)
+        if isinstance(state.get("links"), dict):
+            return state
+    except (OSError, ValueError, AttributeError):
+        pass
+    return {"links": {}}
+
+
+def save_server_list_state(state):
+    try:
+        with open(LOCAL_SERVER_LISTS_FILE + ".tmp", 'w') as file:
+            json.dump(state, file)
+        os.replace(LOCAL_SERVER_LISTS_FILE + ".tmp", LOCAL_SERVER_LISTS_FILE)
+    except OSError as e:
+        print(f"Error writing {LOCAL_SERVER_LISTS_FILE}: {e}")
+
+
 # Restart Passwall2 service
 def restart_passwall2_service():
     try:
         subprocess.run(["/etc/init.d/passwall2", "restart"], check=True)
         print("passwall2 service restarted successfully.")
+        return True
     except subprocess.CalledProcessError as e:
         print(f"Error restarting passwall2 service: {e}")
     except FileNotFoundError:
         print("Command not found. Ensure /etc/init.d/passwall2 exists.")
+    return False
 
 
-# Parse VLESS link
-def parse_vless(vless_link):
+# Parse VLESS link into its fields
+def vless_fields(vless_link):
     match = re.match(r"^vless://([a-fA-F0-9-]+)@([a-zA-Z0-9\.\-]+):(\d+)", vless_link)
     if not match:
         raise ValueError("Invalid VLESS link format: Could not extract UUID, address, or port.")
@@ -105,135 +230,257 @@ def parse_vless(vless_link):
         remarks = "No remarks"
 
     params_dict = {k: v for k, v in (param.split("=", 1) for param in params.split("&"))}
-    encryption = params_dict.get("encryption", "none")
-    security = params_dict.get("security", "")
-    sni = params_dict.get("sni", "")
-    fingerprint = params_dict.get("fp", "")
-    transport = params_dict.get("type", "")
-    ws_host = params_dict.get("host", "")
-    ws_path = urllib.parse.unquote(params_dict.get("path", ""))
 
     # Determine transport type (set raw or ws based on "type")
-    if transport == "ws":
-        transport = "ws"
+    transport = "ws" if params_dict.get("type", "") == "ws" else "raw"
+
+    return {
+        "uuid": uuid,
+        "address": address,
+        "port": port,
+        "remarks": remarks,
+        "encryption": params_dict.get("encryption", "none"),
+        "security": params_dict.get("security", ""),
+        "sni": params_dict.get("sni", ""),
+        "fingerprint": params_dict.get("fp", ""),
+        "transport": transport,
+        "ws_host": params_dict.get("host", ""),
+        "ws_path": urllib.parse.unquote(params_dict.get("path", "")),
+    }
+
+
+# Parse VLESS link into the options of a passwall2 node section
+def parse_vless(vless_link):
+    fields = vless_fields(vless_link)
+    return {
+        "tls": "1" if fields["security"] == "tls" else "0",
+        "protocol": "vless",
+        "encryption": fields["encryption"],
+        "add_from": "导入",
+        "port": fields["port"],
+        "ws_path": fields["ws_path"],
+        "remarks": fields["remarks"],
+        "add_mode": "1",
+        "ws_host": fields["ws_host"],
+        "type": "Xray",
+        "timeout": "60",
+        "fingerprint": fields["fingerprint"],
+        "tls_serverName": fields["sni"],
+        "address": fields["address"],
+        "tls_allowInsecure": "1",  # Assuming '1' by default for tls_allowInsecure
+        "uuid": fields["uuid"],
+        "transport": fields["transport"],
+        "tcp_guise": "http",
+        "tcp_guise_http_host": fields["ws_host"],
+    }
+
+
+# Update Passwall2 configuration file: set the primary node and the backup nodes in place and
+# drop backup nodes left over from a longer list. The file is only written when it changes.
+def update_passwall2_file(nodes):
+    config = UciConfig.load(PASSWALL2_CONFIG)
+    backup_node = re.compile(rf"{PRIMARY_NODE}_b\d+")
+    for section in config.sections("nodes"):
+        if section.name and backup_node.fullmatch(section.name) and section.name not in nodes:
+            config.remove(section.name)
+    for node_id, options in nodes.items():
+        config.set_section("nodes", node_id, options)
+
+    if config.save():
+        print("passwall2 file updated.")
     else:
-        transport = "raw"
-
-    # Prepare the output in the required format
-    output = f"""
-config nodes 'lFQCkuzv'
-    option tls '{1 if security == 'tls' else 0}'
-    option protocol 'vless'
-    option encryption '{encryption}'
-    option add_from '导入'
-    option port '{port}'
-    option ws_path '{ws_path}'
-    option remarks '{remarks}'
-    option add_mode '1'
-    option ws_host '{ws_host}'
-    option type 'Xray'
-    option timeout '60'
-    option fingerprint '{fingerprint}'
-    option tls_serverName '{sni}'
-    option address '{address}'
-    option tls_allowInsecure '1'  # Assuming '1' by default for tls_allowInsecure
-    option uuid '{uuid}'
-    option transport '{transport}'
-    option tcp_guise 'http'
-    option tcp_guise_http_host '{ws_host}'
-""".strip()
-
-    return output
-
-
-# Update Passwall2 configuration file
-def update_passwall2_file(new_config):
-    file_path = "/etc/config/passwall2"
-
-    with open(file_path, "r", encoding="utf-8") as file:
-        lines = file.readlines()
-
-    start_index = None
-    for i in range(len(lines) - 1, -1, -1):
-        if lines[i].strip().startswith("config nodes 'lFQCkuzv'"):
-            start_index = i
-            break
-
-    if start_index is not None:
-        end_index = start_index + 1
-        while end_index < len(lines) and lines[end_index].strip().startswith("option"):
-            end_index += 1
-        del lines[start_index:end_index]
-
-    lines.append(new_config + "\n")
-
-    with open(file_path, "w", encoding="utf-8") as file:
-        file.writelines(lines)
-
-    print("passwall2 file updated.")
-
-
-# File path for storing server location
-SERVER_LOCATION_FILE = "/root/server_location.txt"
-
-
-# Function to read the server base URL from the file
-def get_base_url():
-    if os.path.exists(SERVER_LOCATION_FILE):
-        try:
-            with open(SERVER_LOCATION_FILE, 'r') as file:
-                base_url = file.readline().strip()
-                if base_url:  # Ensure the URL is not empty
-                    return base_url.rstrip('/') + '/'  # Ensure it ends with a slash
-        except Exception as e:
-            print(f"Error reading server location file: {e}")
-    print("Server location file not found or invalid. Exiting.")
-    exit()
+        print("passwall2 file already up to date.")
+
+
+# Time the TCP connect and, for TLS nodes, the TLS handshake with the node's SNI; None if
+# either fails. Certificates are not checked, as the node config sets tls_allowInsecure.
+def probe_node(fields):
+    started = time.monotonic()
+    try:
+        with socket.create_connection((fields["address"], int(fields["port"])), timeout=NODE_PROBE_TIMEOUT) as sock:
+            if fields["security"] == "tls":
+                context = ssl.create_default_context()
+                context.check_hostname = False
+                context.verify_mode = ssl.CERT_NONE
+                with context.wrap_socket(sock, server_hostname=fields["sni"] or fields["address"]):
+                    pass
+    except (OSError, ValueError):
+        return None
+    return time.monotonic() - started
+
+
+# Probe all candidate links at the same time; healthy ones first, fastest first
+def rank_nodes(candidates):
+    with ThreadPoolExecutor(max_workers=min(NODE_PROBE_WORKERS, len(candidates))) as executor:
+        latencies = list(executor.map(lambda node: probe_node(node["fields"]), candidates))
+    for node, latency in zip(candidates, latencies):
+        node["latency"] = latency
+    return sorted(candidates, key=lambda node: (node["latency"] is None, node["latency"] or 0))
+
+
+# Order the healthy nodes for passwall2: the fastest first, unless the current node is
+# within NODE_SWITCH_MARGIN of it (or avoid_current asks for any other node)
+def choose_nodes(ranked, current_link, avoid_current=False):
+    healthy = [node for node in ranked if node["latency"] is not None]
+    if not healthy:
+        return []
+    current = next((node for node in healthy if node["link"] == current_link), None)
+    if avoid_current and current and len(healthy) > 1:
+        healthy.remove(current)
+        healthy.append(current)
+    elif current and current["latency"] <= healthy[0]["latency"] * (1 + NODE_SWITCH_MARGIN):
+        healthy.remove(current)
+        healthy.insert(0, current)
+    return healthy[:1 + MAX_BACKUP_NODES]
 
 
 LOCAL_LINK_FILE = "/root/v2ray_link.txt"
 
+# Last full device-v2ray response, reused when the server answers 304
+LOCAL_DEVICE_V2RAY_FILE = "/root/device_v2ray.json"
+
+# Link of each server list, reused when the server answers 304, and when the server last
+# turned down a ?id__in= request: {"links": {<id>: <link>}, "bulk_unsupported_at": <epoch>}
+LOCAL_SERVER_LISTS_FILE = "/root/server_lists.json"
 
-# Save link locally
-def save_link_locally(vless_link):
-    if os.path.exists(LOCAL_LINK_FILE):
+# Held while applying links: the device-sync handler, this job and change_link may run at once
+V2RAY_LOCK_FILE = "/var/run/get_new_v2ray.lock"
+
+# Candidate links of the last ranking and when it ran: {"links": [...], "ranked_at": <epoch>}
+NODE_RANKING_FILE = "/root/node_ranking.json"
+
+
+# Save the links written to passwall2 locally, the primary one first
+def save_links_locally(vless_links):
+    with open(LOCAL_LINK_FILE + ".tmp", 'w') as file:
+        file.write("\n".join(vless_links) + "\n")
+    os.replace(LOCAL_LINK_FILE + ".tmp", LOCAL_LINK_FILE)
+    print("Links saved locally.")
+
+
+def load_saved_links():
+    try:
         with open(LOCAL_LINK_FILE, 'r') as file:
-            saved_link = file.read().strip()
-            if saved_link == vless_link:
-                print("Same link already saved.")
-                exit()
-    with open(LOCAL_LINK_FILE, 'w') as file:
-        file.write(vless_link)
-    print("Link saved locally.")
+            return [line.strip() for line in file if line.strip()]
+    except OSError:
+        return []
 
 
-# Main script execution
-if __name__ == "__main__":
-    api_url = get_base_url()
-    file_path = "/sys/devices/platform/soc/78b5000.spi/spi_master/spi0/spi0.0/mtd/mtd0/mtd0/nvmem"
+def load_ranking():
+    try:
+        with open(NODE_RANKING_FILE, 'r') as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_ranking(links):
+    try:
+        with open(NODE_RANKING_FILE + ".tmp", 'w') as file:
+            json.dump({"links": links, "ranked_at": time.time()}, file)
+        os.replace(NODE_RANKING_FILE + ".tmp", NODE_RANKING_FILE)
+    except OSError as e:
+        print(f"Error writing {NODE_RANKING_FILE}: {e}")
+
+
+# True if these candidate links were ranked less than max_age seconds ago
+def ranked_recently(links, max_age):
+    ranking = load_ranking()
+    return ranking.get("links") == links and 0 <= time.time() - ranking.get("ranked_at", 0) < max_age
+
+
+# Rank the links of the device-v2ray items ({"server_list", "v2ray_link"}, also from a
+# device-sync reply) by probing them, write the fastest and its backups to passwall2 and
+# report the latencies. passwall2 restarts only when the primary node changed. With max_age
+# (device-sync) nothing is done if the same links were applied less than max_age seconds ago;
+# the ranking only counts once passwall2 runs the chosen nodes, so a failed run is retried.
+def apply_v2ray_links(items, client=None, avoid_current=False, max_age=None):
+    candidates = {}
+    for item in items:
+        vless_link = item.get("v2ray_link")
+        if not vless_link or vless_link in candidates:
+            continue
+        try:
+            candidates[vless_link] = {"server_list": item.get("server_list"), "link": vless_link, "fields": vless_fields(vless_link)}
+        except ValueError as e:
+            print(f"Error: {e}")
+    if not candidates:
+        return
+    links = sorted(candidates)
+    with open(V2RAY_LOCK_FILE, 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        if max_age is not None and ranked_recently(links, max_age):
+            return
+
+        ranked = rank_nodes(list(candidates.values()))
+        for node in ranked:
+            latency = "unreachable" if node["latency"] is None else f"{node['latency'] * 1000:.0f} ms"
+            print(f"Node {node['fields']['address']}:{node['fields']['port']} (server list {node['server_list']}): {latency}")
+
+        saved_links = load_saved_links()
+        chosen = choose_nodes(ranked, saved_links[0] if saved_links else None, avoid_current)
+        for rank, node in enumerate(chosen):
+            node["rank"] = rank
+        if client:
+            report_node_latency(client, ranked)
+        if not chosen:
+            print("No candidate node answered. Keeping the current configuration.")
+            return
+
+        chosen_links = [node["link"] for node in chosen]
+        if chosen_links == saved_links:
+            print("Same links already saved.")
+            save_ranking(links)
+            return
+        node_ids = [PRIMARY_NODE] + [f"{PRIMARY_NODE}_b{rank}" for rank in range(1, len(chosen))]
+        try:
+            update_passwall2_file({node_id: parse_vless(link) for node_id, link in zip(node_ids, chosen_links)})
+            # Only once passwall2 has them: after a failure the next run tries again
+            save_links_locally(chosen_links)
+        except (OSError, ValueError) as e:
+            print(f"Error updating {PASSWALL2_CONFIG}: {e}")
+            return
+        if saved_links[:1] != chosen_links[:1] and not restart_passwall2_service():
+            return
+        save_ranking(links)
+
 
-    # Extract serial numbers
-    mlb_serial_number, serial_number = extract_serial_numbers(file_path)
+# Links delivered with a device-sync reply: probed again only when they changed or after
+# RANK_INTERVAL, not with every heartbeat
+def apply_synced_links(items, client):
+    return apply_v2ray_links(items, client, max_age=RANK_INTERVAL)
+
+
+# Main script execution. avoid_current (from change_link) prefers any healthy node over the
+# current one, which keeps failing, and fetches the links even while device-sync delivers them.
+def main(client=None, avoid_current=False):
+    if sync_recent() and not avoid_current:
+        print("The V2Ray link is delivered by device-sync. Skipping.")
+        return
+
+    client = client or ApiClient()
+
+    # Read the stored serial numbers, extracting them from the device on first run
+    serial_number, mlb_serial_number = get_serial_numbers()
 
     username = serial_number
     password = mlb_serial_number
 
-    token = get_token(api_url, username, password)
+    token = client.get_token(username, password)
     if token:
-        device_v2ray_data = get_device_v2ray(api_url, token)
-        if device_v2ray_data:
-            for item in device_v2ray_data:
-                server_list_id = item.get("server_list")
-                if server_list_id:
-                    server_list_data = get_server_list(api_url, token, server_list_id)
-                    if server_list_data:
-                        vless_link = server_list_data.get("v2ray_link", "No V2Ray link available")
-                        try:
-                            save_link_locally(vless_link)
-                            parsed_output = parse_vless(vless_link)
-                            update_passwall2_file(parsed_output)
-                        except ValueError as e:
-                            print(f"Error: {e}")
-        restart_passwall2_service()
+        validators = ValidatorCache()
+        device_v2ray_data = get_device_v2ray(client, validators)
+        server_list_ids = [item["server_list"] for item in device_v2ray_data or [] if item.get("server_list")]
+        links = get_server_lists(client, server_list_ids, validators)
+        items = [
+            {"server_list": server_list_id, "v2ray_link": links[str(server_list_id)]}
+            for server_list_id in server_list_ids
+            if str(server_list_id) in links
+        ]
+        apply_v2ray_links(items, client, avoid_current)
     else:
         print("Failed to obtain token.")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,5 @@
 import os
-import requests
+from api_client import RequestException, ValidatorCache, get_session
 
 # Raw GitHub file URL
 GITHUB_FILE_URL = "https://raw.githubusercontent.com/behjaf/google/main/v2ray_server"
@@ -7,15 +7,16 @@ GITHUB_FILE_URL = "https://raw.githubusercontent.com/behjaf/google/main/v2ray_se
 # File path for storing server location
 SERVER_LOCATION_PATH = "/root/server_location.txt"
 
-def fetch_github_file_content(url):
+def fetch_github_file(url, validators):
     try:
-        # Send a GET request to the GitHub file URL
-        response = requests.get(url)
+        # Send a conditional GET request to the GitHub file URL (304 when nothing changed)
+        headers = validators.headers(url) if os.path.exists(SERVER_LOCATION_PATH) else {}
+        response = get_session().get(url, headers=headers, timeout=(5, 15))
         response.raise_for_status()  # Raise an exception for HTTP errors
 
-        # Return the content of the file
-        return response.text
-    except requests.exceptions.RequestException as e:
+        # Return the response; its text is the file content unless the status is 304
+        return response
+    except RequestException as e:
         # Handle any errors during the request
         print(f"An error occurred while fetching the file: {e}")
         return None
@@ -39,14 +40,22 @@ def read_server_address_from_file():
         print(f"Error reading from file: {e}")
         return None
 
-if __name__ == "__main__":
+def main():
     # Fetch the content of the GitHub file
-    new_content = fetch_github_file_content(GITHUB_FILE_URL)
+    validators = ValidatorCache()
+    response = fetch_github_file(GITHUB_FILE_URL, validators)
 
-    if new_content is not None:  # Only update if new content was fetched successfully
-        write_server_address_to_file(new_content)
-        print("Updated server address:")
-        print(new_content)
+    if response is not None and response.status_code == 304:
+        print("Server address unchanged.")
+    elif response is not None:  # Only update if new content was fetched successfully
+        new_content = response.text
+        if new_content != read_server_address_from_file():
+            write_server_address_to_file(new_content)
+            print("Updated server address:")
+            print(new_content)
+        else:
+            print("Server address unchanged.")
+        validators.remember(GITHUB_FILE_URL, response)
     else:
         current_content = read_server_address_from_file()
         if current_content is not None:
@@ -54,3 +63,7 @@ if __name__ == "__main__":
             print(current_content)
         else:
             print("Failed to fetch new server address and no existing address found.")
+
+
+if __name__ == "__main__":
+    main()
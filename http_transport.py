@@ -0,0 +1,247 @@
+import http.client
+import threading
+import urllib.parse
+from json import dumps as json_dumps, loads as json_loads
+
+# Sent with every request unless the caller overrides it
+DEFAULT_HEADERS = {
+    "User-Agent": "router-agent",
+    "Accept": "*/*",
+    "Accept-Encoding": "identity",
+}
+
+# Redirects followed before giving up, as in requests
+MAX_REDIRECTS = 30
+
+REDIRECT_CODES = (301, 302, 303, 307, 308)
+
+
+class RequestException(IOError):
+    """Base of every error raised by this transport (requests.RequestException counterpart)."""
+
+    def __init__(self, *args, response=None):
+        super().__init__(*args)
+        self.response = response
+
+
+class ConnectionError(RequestException):
+    pass
+
+
+class Timeout(RequestException):
+    pass
+
+
+class HTTPError(RequestException):
+    pass
+
+
+class TooManyRedirects(RequestException):
+    pass
+
+
+def connection_error(e):
+    if isinstance(e, TimeoutError):
+        return Timeout(e)
+    return ConnectionError(e)
+
+
+class Response:
+    """The parts of requests.Response the agent uses."""
+
+    def __init__(self, session, key, connection, raw, url):
+        self.session = session
+        self.key = key
+        self.connection = connection
+        self.raw = raw
+        self.url = url
+        self.status_code = raw.status
+        self.reason = raw.reason
+        # http.client.HTTPMessage: get() is case-insensitive like requests' headers
+        self.headers = raw.headers
+        self._content = None
+
+    @property
+    def ok(self):
+        return self.status_code < 400
+
+    @property
+    def content(self):
+        if self._content is None:
+            self._content = b"".join(self.iter_content(64 * 1024))
+        return self._content
+
+    @property
+    def text(self):
+        charset = self.headers.get_content_charset() or "utf-8"
+        return self.content.decode(charset, errors="replace")
+
+    def json(self):
+        return json_loads(self.content)
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            kind = "Client" if self.status_code < 500 else "Server"
+            raise HTTPError(f"{self.status_code} {kind} Error: {self.reason} for url: {self.url}", response=self)
+
+    def iter_content(self, chunk_size=1):
+        if self._content is not None:
+            yield self._content
+            return
+        try:
+            while True:
+                chunk = self.raw.read(chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+        except (OSError, http.client.HTTPException) as e:
+            self.close()
+            raise connection_error(e)
+        self.release()
+
+    def release(self):
+        """Hand the connection back to the pool once the body has been read to the end."""
+        if self.connection is not None:
+            reusable = self.raw.isclosed() and not self.raw.will_close
+            self.session.put_connection(self.key, self.connection if reusable else None)
+            self.connection = None
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.session.put_connection(self.key, None)
+            self.connection = None
+
+    def __del__(self):
+        # A stream=True response dropped unread (a 304, an error status) must not keep its slot
+        try:
+            self.close()
+        except Exception:
+            pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class Session:
+    """Keep-alive HTTP(S) client on http.client with the requests.Session call signature.
+
+    At most pool_maxsize connections are open to one host; further requests wait for one
+    to be released, like requests' HTTPAdapter(pool_block=True), and raise Timeout after
+    pool_timeout seconds (None: wait forever). A response holds its connection until its
+    body has been read (or it is closed), so stream=True responses must be consumed or closed.
+    """
+
+    def __init__(self, pool_maxsize=4, pool_timeout=None):
+        self.pool_maxsize = pool_maxsize
+        self.pool_timeout = pool_timeout
+        self.lock = threading.Lock()
+        self.idle = {}
+        self.slots = {}
+        self.ssl_context = None
+
+    def get_connection(self, key):
+        """Wait for a free slot to the host; return (connection, reused)."""
+        with self.lock:
+            slots = self.slots.setdefault(key, threading.BoundedSemaphore(self.pool_maxsize))
+        if not slots.acquire(timeout=self.pool_timeout):
+            raise Timeout(f"No free connection to {key[1]}:{key[2]} after {self.pool_timeout} seconds")
+        with self.lock:
+            idle = self.idle.get(key)
+            if idle:
+                return idle.pop(), True
+
+        scheme, host, port = key
+        if scheme == "https":
+            if self.ssl_context is None:
+                import ssl
+                self.ssl_context = ssl.create_default_context()
+            return http.client.HTTPSConnection(host, port, context=self.ssl_context), False
+        return http.client.HTTPConnection(host, port), False
+
+    def put_connection(self, key, connection):
+        """Release a slot; an open connection is kept for reuse, None means it was closed."""
+        with self.lock:
+            if connection is not None:
+                self.idle.setdefault(key, []).append(connection)
+            self.slots[key].release()
+
+    def send(self, method, url, body, headers, timeout):
+        parts = urllib.parse.urlsplit(url)
+        if parts.scheme not in ("http", "https") or not parts.hostname:
+            raise RequestException(f"Invalid URL: {url}")
+        key = (parts.scheme, parts.hostname, parts.port or (443 if parts.scheme == "https" else 80))
+        target = parts.path or "/"
+        if parts.query:
+            target += "?" + parts.query
+        connect_timeout, read_timeout = timeout if isinstance(timeout, tuple) else (timeout, timeout)
+
+        connection, reused = self.get_connection(key)
+        try:
+            while True:
+                try:
+                    if connection.sock is None:
+                        connection.timeout = connect_timeout
+                        connection.connect()
+                    connection.sock.settimeout(read_timeout)
+                    connection.request(method, target, body=body, headers=headers)
+                    raw = connection.getresponse()
+                    break
+                except (ConnectionResetError, BrokenPipeError, http.client.RemoteDisconnected):
+                    # The server closed an idle keep-alive connection: retry once on a new one
+                    connection.close()
+                    if not reused:
+                        raise
+                    reused = False
+        except (OSError, http.client.HTTPException) as e:
+            connection.close()
+            self.put_connection(key, None)
+            raise connection_error(e)
+        return Response(self, key, connection, raw, url)
+
+    def request(self, method, url, params=None, data=None, json=None, headers=None, timeout=None, stream=False):
+        method = method.upper()
+        if params:
+            url += ("&" if urllib.parse.urlsplit(url).query else "?") + urllib.parse.urlencode(params, doseq=True)
+        request_headers = dict(DEFAULT_HEADERS)
+        request_headers.update(headers or {})
+
+        body = None
+        if json is not None:
+            body = json_dumps(json).encode()
+            request_headers.setdefault("Content-Type", "application/json")
+        elif isinstance(data, dict):
+            body = urllib.parse.urlencode(data, doseq=True).encode()
+            request_headers.setdefault("Content-Type", "application/x-www-form-urlencoded")
+        elif data is not None:
+            body = data.encode() if isinstance(data, str) else data
+
+        for _ in range(MAX_REDIRECTS + 1):
+            response = self.send(method, url, body, request_headers, timeout)
+            location = response.headers.get("Location")
+            if response.status_code not in REDIRECT_CODES or not location:
+                if not stream:
+                    response.content  # Read the body now, which frees the connection
+                return response
+
+            response.close()
+            next_url = urllib.parse.urljoin(url, location)
+            if urllib.parse.urlsplit(next_url).netloc != urllib.parse.urlsplit(url).netloc:
+                request_headers.pop("Authorization", None)
+            if response.status_code == 303 or (response.status_code in (301, 302) and method == "POST"):
+                method, body = ("HEAD" if method == "HEAD" else "GET"), None
+                request_headers.pop("Content-Type", None)
+            url = next_url
+        raise TooManyRedirects(f"Exceeded {MAX_REDIRECTS} redirects.")
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def patch(self, url, **kwargs):
+        return self.request("PATCH", url, **kwargs)
@@ -0,0 +1,165 @@
+import json
+import mmap
+import os
+import re
+import zlib
+
+# Path to the file containing the serial numbers
+NVMEM_PATH = "/sys/devices/platform/soc/78b5000.spi/spi_master/spi0/spi0.0/mtd/mtd0/mtd0/nvmem"
+
+# File path for storing serial numbers
+SERIAL_FILE_PATH = "/root/serial_numbers.txt"
+
+# Checksum of the nvmem blob the stored serial numbers were extracted from
+SERIAL_CHECKSUM_PATH = "/root/serial_numbers.crc"
+
+# Device id the server assigned to this router, with the serial and server it belongs to
+DEVICE_IDENTITY_PATH = "/root/device_identity.json"
+
+# Markers as they appear in the raw blob; values may be separated by whitespace or NUL padding
+MLB_SERIAL_PATTERN = re.compile(rb"mlb_serial_number[\s\x00]+([A-Za-z0-9]+)")
+SERIAL_PATTERN = re.compile(rb"\bserial_number[\s\x00]+([A-Za-z0-9]+)")
+
+
+def open_nvmem(file_path):
+    """Return a read-only view of the blob: an mmap when the file supports it, else its bytes."""
+    with open(file_path, "rb") as file:
+        try:
+            return mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, OSError):
+            # sysfs nvmem attributes usually cannot be mapped
+            return file.read()
+
+
+def find_value(data, marker, pattern):
+    """Locate marker with a plain byte search and match the value right after it."""
+    start = data.find(marker)
+    while start != -1:
+        match = pattern.match(data, start)
+        if match:
+            return match.group(1).decode()
+        start = data.find(marker, start + 1)
+    return None
+
+
+def blob_checksum(data):
+    return f"{len(data)}:{zlib.crc32(data):08x}"
+
+
+def nvmem_checksum(file_path):
+    data = open_nvmem(file_path)
+    try:
+        return blob_checksum(data)
+    finally:
+        if isinstance(data, mmap.mmap):
+            data.close()
+
+
+# Extract serial numbers directly from the nvmem bytes (no `strings` subprocess)
+def extract_serial_numbers(file_path=NVMEM_PATH):
+    try:
+        data = open_nvmem(file_path)
+        try:
+            serial_number = find_value(data, b"serial_number", SERIAL_PATTERN)
+            mlb_serial_number = find_value(data, b"mlb_serial_number", MLB_SERIAL_PATTERN)
+            checksum = blob_checksum(data)
+        finally:
+            if isinstance(data, mmap.mmap):
+                data.close()
+
+        return serial_number, mlb_serial_number, checksum
+    except Exception as e:
+        print(f"Error extracting serial numbers: {e}")
+        return None, None, None
+
+
+# Function to read serial numbers from file
+def read_serial_numbers_from_file():
+    if os.path.exists(SERIAL_FILE_PATH):
+        try:
+            with open(SERIAL_FILE_PATH, 'r') as file:
+                lines = file.readlines()
+                if len(lines) >= 2:
+                    return lines[0].strip(), lines[1].strip()  # Return both serials
+        except Exception as e:
+            print(f"Error reading from file: {e}")
+    return None, None
+
+
+# Function to write serial numbers (and the source checksum) to file
+def write_serial_numbers_to_file(serial_number, mlb_serial_number, checksum=None):
+    try:
+        with open(SERIAL_FILE_PATH, 'w') as file:
+            file.write(f"{serial_number}\n{mlb_serial_number}\n")
+        if checksum:
+            with open(SERIAL_CHECKSUM_PATH, 'w') as file:
+                file.write(checksum)
+    except Exception as e:
+        print(f"Error writing to file: {e}")
+
+
+def read_checksum():
+    try:
+        with open(SERIAL_CHECKSUM_PATH, 'r') as file:
+            return file.read().strip()
+    except OSError:
+        return None
+
+
+def get_serial_numbers(file_path=NVMEM_PATH, verify=False):
+    """Return (serial_number, mlb_serial_number), scanning the nvmem blob only when needed.
+
+    The stored serials are used as they are unless verify is set, in which case they are
+    reused only while the blob checksum still matches the one they were extracted from.
+    """
+    serial_number, mlb_serial_number = read_serial_numbers_from_file()
+    if serial_number and mlb_serial_number:
+        if not verify:
+            return serial_number, mlb_serial_number
+        try:
+            if read_checksum() == nvmem_checksum(file_path):
+                return serial_number, mlb_serial_number
+        except OSError as e:
+            print(f"Error checking nvmem checksum: {e}")
+            return serial_number, mlb_serial_number
+        print("nvmem checksum changed. Extracting serial numbers again...")
+    else:
+        print("Serial numbers not found in file. Extracting from device...")
+
+    serial_number, mlb_serial_number, checksum = extract_serial_numbers(file_path)
+    if serial_number and mlb_serial_number:
+        print(f"Extracted serial numbers: {serial_number}, {mlb_serial_number}")
+        write_serial_numbers_to_file(serial_number, mlb_serial_number, checksum)
+        return serial_number, mlb_serial_number
+
+    print("Failed to extract serial numbers.")
+    return None, None
+
+
+# Return the stored device id if it was recorded for this serial number and server
+def load_device_id(serial_number, server_url):
+    try:
+        with open(DEVICE_IDENTITY_PATH, 'r') as file:
+            record = json.load(file)
+    except (OSError, ValueError):
+        return None
+    if record.get("serial_number") == serial_number and record.get("server") == server_url:
+        return record.get("device_id")
+    return None
+
+
+def save_device_id(device_id, serial_number, server_url):
+    try:
+        temp_path = DEVICE_IDENTITY_PATH + ".tmp"
+        with open(temp_path, 'w') as file:
+            json.dump({"device_id": device_id, "serial_number": serial_number, "server": server_url}, file)
+        os.replace(temp_path, DEVICE_IDENTITY_PATH)
+    except Exception as e:
+        print(f"Error writing device identity: {e}")
+
+
+def forget_device_id():
+    try:
+        os.remove(DEVICE_IDENTITY_PATH)
+    except FileNotFoundError:
+        pass
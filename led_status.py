@@ -0,0 +1,234 @@
+import fcntl
+import json
+import os
+import queue
+import socket
+import struct
+import threading
+import time
+import urllib.parse
+
+URL_TELEGRAM = "https://telegram.org"
+URL_GOOGLE = "https://www.google.com"
+# SOCKS5 proxy of passwall2; host names are resolved by the proxy (socks5h)
+PROXY = ("127.0.0.1", 1070)
+
+# Seconds to wait for the TCP connection, and for the proxy, TLS and HTTP exchanges after it
+PROBE_CONNECT_TIMEOUT = 2
+PROBE_TIMEOUT = 4
+
+# Tries per probe. Another try starts when one fails, or when none has answered for
+# HEDGE_DELAY seconds (a lost SYN or slow DNS); the first success wins.
+PROBE_ATTEMPTS = 3
+HEDGE_DELAY = 1
+# A probe without any success after this many seconds counts as failed
+PROBE_DEADLINE = 6
+
+# Last probe result on tmpfs, read by online and change_link instead of the LED triggers:
+# {"status": ..., "checked_at": <epoch>, "duration": <s>, "latency": {"google": <s or null>, "telegram": ...}}
+STATUS_CACHE_PATH = "/tmp/connectivity_status.json"
+STATUS_LOCK_FILE = "/tmp/connectivity_status.lock"
+
+# Older records are stale (this job runs every 2 minutes): readers then probe themselves
+STATUS_MAX_AGE = 300
+
+LED_RED = "/sys/class/leds/LED0_Red/trigger"
+LED_GREEN = "/sys/class/leds/LED0_Green/trigger"
+LED_BLUE = "/sys/class/leds/LED0_Blue/trigger"
+
+# Triggers of the red, green and blue LEDs for each status
+LED_TRIGGERS = {
+    "green-blue": ("none", "default-on", "default-on"),
+    "green-red": ("default-on", "default-on", "none"),
+    "red-heartbeat": ("heartbeat", "none", "none"),
+}
+
+
+def recv_exact(sock, size):
+    data = b""
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError("Connection closed by proxy")
+        data += chunk
+    return data
+
+
+# Function to open a tunnel to host:port through a SOCKS5 proxy (no authentication)
+def socks5_connect(proxy, host, port):
+    sock = socket.create_connection(proxy, timeout=PROBE_CONNECT_TIMEOUT)
+    try:
+        sock.settimeout(PROBE_TIMEOUT)
+        sock.sendall(b"\x05\x01\x00")
+        if recv_exact(sock, 2) != b"\x05\x00":
+            raise ConnectionError("Proxy refused the authentication method")
+        name = host.encode("idna")
+        sock.sendall(b"\x05\x01\x00\x03" + bytes([len(name)]) + name + struct.pack("!H", port))
+        version, reply, _, address_type = recv_exact(sock, 4)
+        if reply != 0:
+            raise ConnectionError(f"Proxy could not connect (SOCKS5 reply {reply})")
+        # Skip the bound address
+        address_size = {1: 4, 4: 16}.get(address_type) or recv_exact(sock, 1)[0]
+        recv_exact(sock, address_size + 2)
+        return sock
+    except Exception:
+        sock.close()
+        raise
+
+
+# Function to check that an HTTPS request to url completes (through the proxy, if given)
+def probe(url, proxy=None):
+    import ssl
+
+    parts = urllib.parse.urlsplit(url)
+    host, port = parts.hostname, parts.port or 443
+    if proxy:
+        sock = socks5_connect(proxy, host, port)
+    else:
+        sock = socket.create_connection((host, port), timeout=PROBE_CONNECT_TIMEOUT)
+    try:
+        sock.settimeout(PROBE_TIMEOUT)
+        with ssl.create_default_context().wrap_socket(sock, server_hostname=host) as tls:
+            tls.sendall(f"HEAD {parts.path or '/'} HTTP/1.1\r\nHost: {host}\r\nConnection: close\r\n\r\n".encode())
+            return tls.recv(16).startswith(b"HTTP/")
+    finally:
+        sock.close()
+
+
+def attempt(results, url, proxy):
+    started = time.monotonic()
+    try:
+        ok = probe(url, proxy)
+    except (OSError, ValueError):
+        ok = False
+    results.put(time.monotonic() - started if ok else None)
+
+
+def hedged_probe(url, proxy=None):
+    """Seconds the first successful of up to PROBE_ATTEMPTS overlapping tries of probe()
+    took, as soon as it succeeds; None if all failed or PROBE_DEADLINE passed."""
+    results = queue.Queue()
+    deadline = time.monotonic() + PROBE_DEADLINE
+    started = failed = 0
+    next_start = time.monotonic()
+    while True:
+        now = time.monotonic()
+        if now >= deadline:
+            return None
+        if started < PROBE_ATTEMPTS and (now >= next_start or failed == started):
+            # Daemon threads: a try stuck past the deadline does not hold up the exit
+            threading.Thread(target=attempt, args=(results, url, proxy), daemon=True).start()
+            started += 1
+            next_start = now + HEDGE_DELAY
+        wait = deadline - now
+        if started < PROBE_ATTEMPTS:
+            wait = min(wait, next_start - now)
+        try:
+            latency = results.get(timeout=wait)
+            if latency is not None:
+                return round(latency, 3)
+            failed += 1
+            if failed == PROBE_ATTEMPTS:
+                return None
+        except queue.Empty:
+            pass
+
+
+# Function to classify the connection: direct and proxied probes run at the same time.
+# Returns the status and the latency of each probe (None if it failed or did not finish).
+def detect_status():
+    latency = {}
+
+    def run(name, url, proxy=None):
+        latency[name] = hedged_probe(url, proxy)
+
+    proxied = threading.Thread(target=run, args=("telegram", URL_TELEGRAM, PROXY), daemon=True)
+    proxied.start()
+    run("google", URL_GOOGLE)
+    if latency["google"] is None:
+        # Google not accessible: the proxy result does not matter
+        return "red-heartbeat", {"google": None, "telegram": latency.get("telegram")}
+    proxied.join()
+    return ("green-blue" if latency["telegram"] is not None else "green-red"), dict(latency)
+
+
+# Function to update LED state only if it needs to change
+def update_led(led_path, desired_state):
+    try:
+        with open(led_path, 'r') as led_file:
+            current = led_file.read()
+        # The active trigger is the one inside [...]
+        if f"[{desired_state}]" not in current:
+            with open(led_path, 'w') as led_file:
+                led_file.write(desired_state)
+    except OSError as e:
+        print(f"Error setting {led_path}: {e}")
+
+
+def set_leds(status):
+    red, green, blue = LED_TRIGGERS.get(status, ("none", "none", "none"))
+    update_led(LED_RED, red)
+    update_led(LED_GREEN, green)
+    update_led(LED_BLUE, blue)
+
+
+def status_lock():
+    lock_file = open(STATUS_LOCK_FILE, 'w')
+    fcntl.flock(lock_file, fcntl.LOCK_EX)
+    return lock_file
+
+
+def load_status():
+    try:
+        with open(STATUS_CACHE_PATH, 'r') as status_file:
+            return json.load(status_file)
+    except (OSError, ValueError):
+        return None
+
+
+def status_fresh(record, max_age):
+    # A record from the future (the clock was set back) is stale too
+    return record is not None and 0 <= time.time() - record.get("checked_at", 0) <= max_age
+
+
+# Probe, set the LEDs and write the status record; call with the status lock held
+def probe_and_record():
+    started = time.monotonic()
+    status, latency = detect_status()
+    set_leds(status)
+    record = {
+        "status": status,
+        "checked_at": time.time(),
+        "duration": round(time.monotonic() - started, 3),
+        "latency": latency,
+    }
+    try:
+        with open(STATUS_CACHE_PATH + ".tmp", 'w') as status_file:
+            json.dump(record, status_file)
+        os.replace(STATUS_CACHE_PATH + ".tmp", STATUS_CACHE_PATH)
+    except OSError as e:
+        print(f"Error writing {STATUS_CACHE_PATH}: {e}")
+    print(f"Connection status: {status} ({record['duration']:.1f}s, latency {latency})")
+    return record
+
+
+def connectivity_status(max_age=STATUS_MAX_AGE):
+    """Status from the last probe ("green-blue", "green-red" or "red-heartbeat"); probes now
+    if that record is missing or older than max_age."""
+    record = load_status()
+    if not status_fresh(record, max_age):
+        with status_lock():
+            # Another process may have probed while we waited for the lock
+            record = load_status()
+            if not status_fresh(record, max_age):
+                record = probe_and_record()
+    return record["status"]
+
+
+def main():
+    with status_lock():
+        probe_and_record()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,203 +1,189 @@
-import requests
 import json
-import subprocess
-import re
 import os
 import time
+from api_client import ApiClient, RequestException
+from device_sync import SYNC_UNSUPPORTED_CODES, handle_sync, mark_unchanged, mark_unsupported, sync_cursors, sync_supported
+from identity import get_serial_numbers, load_device_id
+from led_status import connectivity_status
+from upload_spool import flush_spool, retryable, spool_pending, spool_upload
+import udp_heartbeat
 
-# File path for storing server location
-SERVER_LOCATION_FILE = "/root/server_location.txt"
+# Last full heartbeat sent; while the report is unchanged only a small keepalive is posted
+HEARTBEAT_STATE_PATH = "/root/heartbeat_state.json"
 
+# A full heartbeat is sent at least this often, even if nothing changed
+FULL_HEARTBEAT_INTERVAL = 3600
 
-def detect_status_from_led():
-    try:
-        # Define paths to LED trigger files
-        red_path = "/sys/class/leds/LED0_Red/trigger"
-        green_path = "/sys/class/leds/LED0_Green/trigger"
-        blue_path = "/sys/class/leds/LED0_Blue/trigger"
-
-        # Read the content of each file
-        with open(red_path, 'r') as red_file:
-            red_status = red_file.read().strip()
-        with open(green_path, 'r') as green_file:
-            green_status = green_file.read().strip()
-        with open(blue_path, 'r') as blue_file:
-            blue_status = blue_file.read().strip()
-
-        # Check conditions for 'green-blue' (VPN connected)
-        if '[none]' in red_status and '[default-on]' in green_status and '[default-on]' in blue_status:
-            print("VPN is connected")
-            return "green-blue"
-
-        # Check conditions for 'green-red' (Internet connected, no VPN)
-        elif '[default-on]' in red_status and '[default-on]' in green_status and '[none]' in blue_status:
-            print("Internet is connected but without VPN")
-            return "green-red"
-
-        else:
-            print("Unknown status")
-            return "unknown"
-
-    except FileNotFoundError as e:
-        print(f"Error: {e}")
-        return "error"
-    except Exception as e:
-        print(f"Error: {e}")
-        return "error"
-
-
-# Retry logic
-def retry_request(func, max_retries=4, delay=15):
-    for attempt in range(max_retries):
-        response = func()
-        if response.status_code == 200 or response.status_code == 201:
-            return response
-        else:
-            print(f"Retry {attempt + 1}/{max_retries} failed. Retrying in {delay} seconds...")
-            time.sleep(delay)
-
-    exit()
-
-
-# Function to read the server base URL from the file
-def get_base_url():
-    if os.path.exists(SERVER_LOCATION_FILE):
-        try:
-            with open(SERVER_LOCATION_FILE, 'r') as file:
-                base_url = file.readline().strip()
-                if base_url:  # Ensure the URL is not empty
-                    return base_url.rstrip('/') + '/api/'  # Ensure it ends with a slash
-        except Exception as e:
-            print(f"Error reading server location file: {e}")
-    print("Server location file not found or invalid. Exiting.")
-    exit()
+# After a server rejected a keepalive, only full heartbeats are sent for this long
+KEEPALIVE_RECHECK_INTERVAL = 24 * 3600
 
 
-# Read the base URL dynamically
-BASE_URL = get_base_url()
-TOKEN_URL = f"{BASE_URL}token/"
-DEVICE_URL = f"{BASE_URL}devices/"
-DEVICE_ONLINE_URL = f"{BASE_URL}device-online/"
-
-# File path for storing serial numbers
-SERIAL_FILE_PATH = "/root/serial_numbers.txt"
-
-
-# Function to extract serial numbers from the file
-def extract_serial_numbers(file_path):
+def load_heartbeat_state():
     try:
-        result = subprocess.run(["strings", file_path], capture_output=True, text=True)
-        if result.returncode != 0:
-            print("Failed to read the file.")
-            return None, None
-
-        mlb_match = re.search(r"mlb_serial_number\s+([A-Za-z0-9]+)", result.stdout)
-        serial_match = re.search(r"\bserial_number\s+([A-Za-z0-9]+)", result.stdout)
+        with open(HEARTBEAT_STATE_PATH, 'r') as state_file:
+            return json.load(state_file)
+    except (OSError, ValueError):
+        return {}
 
-        mlb_serial_number = mlb_match.group(1) if mlb_match else None
-        serial_number = serial_match.group(1) if serial_match else None
 
-        return mlb_serial_number, serial_number
-
-    except Exception as e:
-        print(f"Error extracting serial numbers: {e}")
-        return None, None
-
-
-# Function to read serial numbers from file
-def read_serial_numbers_from_file():
-    if os.path.exists(SERIAL_FILE_PATH):
-        try:
-            with open(SERIAL_FILE_PATH, 'r') as file:
-                lines = file.readlines()
-                if len(lines) == 2:
-                    return lines[0].strip(), lines[1].strip()  # Return both serials
-        except Exception as e:
-            print(f"Error reading from file: {e}")
-    return None, None
-
-
-# Function to write serial numbers to file
-def write_serial_numbers_to_file(serial_number, mlb_serial_number):
+def save_heartbeat_state(state):
     try:
-        with open(SERIAL_FILE_PATH, 'w') as file:
-            file.write(f"{serial_number}\n{mlb_serial_number}\n")
-    except Exception as e:
-        print(f"Error writing to file: {e}")
-
-
-# Check if serial numbers file exists, if not extract and save
-serial_number, mlb_serial_number = read_serial_numbers_from_file()
-
-if not mlb_serial_number or not serial_number:
-    print("Serial numbers not found in file. Extracting from device...")
-    # Path to the file containing the serial numbers
-    file_path = "/sys/devices/platform/soc/78b5000.spi/spi_master/spi0/spi0.0/mtd/mtd0/mtd0/nvmem"
-    mlb_serial_number, serial_number = extract_serial_numbers(file_path)
-
-    if mlb_serial_number and serial_number:
-        print(f"Extracted serial numbers: {serial_number}, {mlb_serial_number}")
-        # Write the extracted serial numbers to the file
-        write_serial_numbers_to_file(serial_number, mlb_serial_number)
-    else:
-        print("Failed to extract serial numbers.")
+        with open(HEARTBEAT_STATE_PATH + ".tmp", 'w') as state_file:
+            json.dump(state, state_file)
+        os.replace(HEARTBEAT_STATE_PATH + ".tmp", HEARTBEAT_STATE_PATH)
+    except OSError as e:
+        print(f"Error writing heartbeat state: {e}")
+
+
+def heartbeat_payload(report, server_url):
+    """The full report when it changed since the last full heartbeat, when that one is
+    FULL_HEARTBEAT_INTERVAL old or when the server rejects keepalives; otherwise a keepalive,
+    which only says the device is alive and its state is as last reported."""
+    state = load_heartbeat_state()
+    now = time.time()
+    if (state.get("server_url") != server_url or state.get("report") != report
+            or state.get("sent_at", 0) + FULL_HEARTBEAT_INTERVAL <= now
+            or state.get("keepalive_rejected_at", 0) + KEEPALIVE_RECHECK_INTERVAL > now):
+        return dict(report)
+    return {"device": report["device"], "keepalive": True}
+
+
+def mark_full_heartbeat(report, server_url):
+    state = load_heartbeat_state()
+    state.update(server_url=server_url, report=report, sent_at=time.time())
+    save_heartbeat_state(state)
+
+
+def mark_keepalive_rejected():
+    state = load_heartbeat_state()
+    state["keepalive_rejected_at"] = time.time()
+    save_heartbeat_state(state)
+
+
+# Heartbeat as one small UDP datagram, when a receiver is configured (see udp_heartbeat).
+# True when the server acknowledged it and has nothing new for the device, so no HTTPS
+# request is needed; otherwise online falls back to the HTTPS heartbeat.
+def post_udp_heartbeat(client, serial_number, mlb_serial_number, vpn_status):
+    target = udp_heartbeat.load_target()
+    device_id = load_device_id(serial_number, client.server_url)
+    packet_id = udp_heartbeat.packet_device_id(device_id)
+    if target is None or packet_id is None or spool_pending():
+        return False
+
+    report = {
+        "serial_number": serial_number,
+        "mlb_serial_number": mlb_serial_number,
+        "device": device_id,
+        "vpn_status": vpn_status,
+    }
+    keepalive = heartbeat_payload(report, client.server_url).get("keepalive")
+    flags = (udp_heartbeat.FLAG_VPN if vpn_status else 0) | (udp_heartbeat.FLAG_KEEPALIVE if keepalive else 0)
+    ack = udp_heartbeat.send_heartbeat(target, packet_id, flags, udp_heartbeat.device_key(serial_number, mlb_serial_number))
+    if ack is None:
+        print("UDP heartbeat was not acknowledged. Using HTTPS.")
+        return False
+    if not keepalive:
+        mark_full_heartbeat(report, client.server_url)
+    if ack & udp_heartbeat.ACK_SYNC:
+        print("Server has changes for this device. Syncing over HTTPS.")
+        return False
+    mark_unchanged()
+    print("UDP heartbeat acknowledged.")
+    return True
+
+
+def main(client=None):
+    # API client on the shared keep-alive session (reads the server location file)
+    client = client or ApiClient()
+
+    # Read the stored serial numbers, extracting them from the device on first run
+    serial_number, mlb_serial_number = get_serial_numbers()
+
+    if not mlb_serial_number or not serial_number:
         exit()
 
+    vpn_status = connectivity_status() == "green-blue"
 
-# Get token each time the script runs
-def get_token():
-    return requests.post(TOKEN_URL, data={"username": serial_number, "password": mlb_serial_number})
-
-
-response = retry_request(get_token)
-
-token = response.json()["access"]
-# print("Token obtained successfully!")
+    if post_udp_heartbeat(client, serial_number, mlb_serial_number, vpn_status):
+        return
 
-headers = {
-    "Authorization": f"Bearer {token}",
-    "Content-Type": "application/json",
-}
-
-
-# Fetch device ID using serial_number
-def fetch_device():
-    return requests.get(DEVICE_URL, headers=headers, params={"serial_number": serial_number})
-
-
-device_response = retry_request(fetch_device)
-
-device_data = device_response.json()
-
-if device_data:
-    device_id = device_data[0]["id"]
-    net_status = detect_status_from_led()
-    if net_status == "green-blue":
-
-        # Prepare payload for Device_Online green-blue
-        payload = {
-            "serial_number": serial_number,
-            "mlb_serial_number": mlb_serial_number,
-            "device": device_id,
-            "vpn_status": True,
-        }
-
-    else:
-        # Prepare payload for Device_Online
-        payload = {
+    # One attempt only: if the server cannot be reached the heartbeat is spooled and sent
+    # with the next successful one, instead of sleeping here between retries
+    try:
+        if not client.authenticate(serial_number, mlb_serial_number):
+            # The server answered and turned the credentials down: spooling would not help
+            print("Failed to obtain token.")
+            return
+
+        # Device ID from the stored identity record; /api/devices/ is only queried when it is missing
+        device_id = client.device_id(serial_number)
+        if device_id is None:
+            print(f"No device found for serial number: {serial_number}")
+            return
+
+        # Reported state; posted in full only when it changed (see heartbeat_payload)
+        report = {
             "serial_number": serial_number,
             "mlb_serial_number": mlb_serial_number,
             "device": device_id,
-            "vpn_status": False,
+            "vpn_status": vpn_status,
         }
+        payload = heartbeat_payload(report, client.server_url)
+
+        # Post the heartbeat with send (device_online or device_sync)
+        def post_heartbeat(send, rejected=(400, 404)):
+            nonlocal payload
+            response = send(payload)
+            if response.status_code == 400 and payload.get("keepalive"):
+                payload = dict(report)
+                response = send(payload)
+                if response.status_code != 400:
+                    print("Server does not accept keepalives. Sending full heartbeats.")
+                    mark_keepalive_rejected()
+            if response.status_code in rejected:
+                # The server rejected the stored device ID: look it up again and resend once
+                payload["device"] = report["device"] = client.device_id(serial_number, refresh=True)
+                if payload["device"] is not None:
+                    response = send(payload)
+            response.raise_for_status()
+            return response
 
-
-    # Post to Device_Online
-    def post_device_online():
-        return requests.post(DEVICE_ONLINE_URL, headers=headers, data=json.dumps(payload))
-
-
-    online_response = retry_request(post_device_online)
-    print("Device online data posted successfully!")
-else:
-    print(f"No device found for serial number: {serial_number}")
+        # One round trip for the heartbeat and every pending job, if the server supports it
+        sync_response = sync_reply = None
+        if sync_supported():
+            cursors = sync_cursors(client.server_url)
+            try:
+                sync_response = post_heartbeat(lambda body: client.device_sync(dict(body, cursors=cursors)), rejected=(400,))
+            except RequestException as e:
+                if e.response is None or e.response.status_code not in SYNC_UNSUPPORTED_CODES:
+                    raise
+                print("Server has no device-sync endpoint. Using device-online.")
+                mark_unsupported()
+            else:
+                # A truncated or malformed reply fails the sync like an error status does
+                sync_reply = sync_response.json()
+                if not isinstance(sync_reply, dict):
+                    raise ValueError("device-sync reply is not a JSON object")
+
+        if sync_response is None:
+            post_heartbeat(client.device_online)
+            print("Device online data posted successfully!")
+        if not payload.get("keepalive"):
+            mark_full_heartbeat(report, client.server_url)
+    except (RequestException, ValueError) as e:
+        print(f"Error posting heartbeat: {e}")
+        # Only when the server was unreachable or failed (see retryable), not for a 4xx
+        if retryable(e):
+            spool_upload("online", {"vpn_status": vpn_status})
+        return
+
+    # The server is reachable again: send what was spooled while it was not
+    flush_spool(client, {key: report[key] for key in ("serial_number", "mlb_serial_number", "device")})
+
+    if sync_reply is not None:
+        handle_sync(client, sync_reply)
+        print("Device sync completed successfully!")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,665 @@
+"""Local stand-in for the device API, for trying the agent without the production server.
+
+It implements the endpoints the agent calls, including the combined device-sync endpoint:
+
+    POST /api/device-sync/   body: the device-online heartbeat
+                             {"serial_number", "mlb_serial_number", "device", "vpn_status"}
+                             or a keepalive {"device", "keepalive": true}
+    200 {"device": <id>, "device_status": <bool>,
+         "commands": [<device-command item>, ...],
+         "files": [<device-file item>, ...],
+         "v2ray": [{"server_list": <id>, "v2ray_link": "vless://..."}, ...]}
+    400 when "device" is not the id of the authenticated device
+
+Servers without the endpoint answer 404 (or 405), and routers fall back to the separate calls.
+Routers post the full heartbeat (to device-sync or device-online) when its fields changed and
+at least hourly; in between they post keepalives, which only mean "alive, state unchanged".
+Servers that need every field answer 400 to a keepalive and get full heartbeats again.
+
+    GET /api/device-command/?cursor=<c>&limit=<n>[&pending=1]   (device-file alike)
+    200 {"results": [<rows changed since the cursor>], "next": <url or null>, "cursor": <c>}
+    An empty cursor starts over; pending=1 then limits the rows to the pending ones. Without
+    a cursor parameter the plain list of every row is returned, as older servers do.
+    With --no-cursors the parameters are ignored as by DRF's LimitOffsetPagination: limit (and
+    offset) page the full list, {"count", "next", "previous", "results"}, with no "cursor".
+    With "cursors": {"commands": <c>, "files": <c>} in its body, device-sync answers with
+    the changed rows and the new "cursors" the same way.
+
+    GET /api/device-command/?wait=<seconds>
+    Long-poll: the reply is held until a command is pending (with a cursor: until a command
+    changed) or wait seconds pass, and carries an "X-Long-Poll: <seconds>" header. Without
+    the header routers keep polling hourly.
+
+    POST /api/device-command/   body: {"command_text": "..."}   queues a command (for testing)
+
+    POST /api/device-batch/   body: {"serial_number", "mlb_serial_number", "device",
+                                     "items": [<spooled upload>, ...]}
+    200 {"accepted": <n>}
+    Uploads a router spooled while the server was unreachable, oldest first: heartbeats
+    {"type": "online", "time", "data": {"vpn_status"}}, {"type": "update", "time"} and the
+    PATCH bodies of commands and files {"type": "command"|"file", "time", "id", "data"}.
+    Servers without it answer 404 and routers replay the acks one by one.
+
+    GET /api/server-list/?id__in=<id>,<id>,...
+    200 [{"id", "v2ray_link"}, ...] for the ids that exist: one request for all the server
+    lists of a device. Servers without the filter answer 404 (or ignore it and return every
+    list), and routers fetch the lists one by one, a few at a time.
+
+    POST /api/node-latency/   body: {"serial_number", "nodes": [{"server_list", "address",
+                                     "port", "latency_ms", "rank"}, ...]}
+    201 with the body. The connect + TLS handshake time get_new_v2ray measured to each
+    candidate node (latency_ms null: unreachable); rank 0 is the node passwall2 uses, 1..
+    its backups, null for nodes not configured. Routers ignore a 404.
+
+    UDP heartbeats (--udp-port): the datagrams of udp_heartbeat.py, acked when the HMAC, the
+    clock and the sequence check out. The ack carries ACK_SYNC while the device has not
+    synced the current state over HTTPS. --udp-bench measures how many the receiver takes.
+
+    GET /files/<name>   (--files DIR)
+    The files of DIR, as raw.githubusercontent.com serves the published scripts and
+    manifest.json: with an ETag, and 304 to a matching If-None-Match. The requests and body
+    bytes sent are counted. --update-bench runs update_checker against this checkout served
+    this way and prints what each run cost.
+
+Usage: python3 reference_server.py [--port 8000] [--state state.json] [--no-sync] [--no-batch]
+                                  [--no-keepalive] [--no-bulk] [--no-cursors] [--delay 0.1] [--udp-port 8001]
+                                  [--files DIR] [--udp-bench] [--update-bench]
+
+--delay holds every reply for that many seconds, to try the agent on a high-latency link.
+
+The state file seeds the data (see DEFAULT_STATE); PATCHes to commands and files update it
+in memory. Tokens are unsigned JWTs that only carry the username and expiry.
+"""
+import argparse
+import base64
+import datetime
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import udp_heartbeat
+
+ACCESS_TOKEN_LIFETIME = 300
+REFRESH_TOKEN_LIFETIME = 86400
+
+# Longest long-poll the server holds, whatever the client asks for
+MAX_LONG_POLL_WAIT = 120
+
+DEFAULT_STATE = {
+    "devices": [
+        {"id": 7, "serial_number": "SN1", "mlb_serial_number": "MLB1", "device_status": True},
+    ],
+    "commands": [
+        {"id": 1, "command_text": "echo hello", "command_status": True, "command_valid_until": "2099-01-01",
+         "command_has_been_applied": False, "command_response": None},
+    ],
+    "files": [],
+    "v2ray": [{"server_list": 1}, {"server_list": 2}],
+    "server_lists": {
+        "1": "vless://02b126eb-b525-4184-8dc2-264f1d7b2938@127.0.0.1:443?type=ws&security=tls&sni=example.com#Reference",
+        "2": "vless://02b126eb-b525-4184-8dc2-264f1d7b2938@127.0.0.1:8443?type=ws&security=tls&sni=example.com#Reference%202",
+    },
+}
+
+
+def make_token(username, lifetime):
+    def encode(data):
+        return base64.urlsafe_b64encode(json.dumps(data).encode()).decode().rstrip("=")
+
+    return ".".join([encode({"alg": "none"}), encode({"username": username, "exp": int(time.time()) + lifetime}), ""])
+
+
+def read_token(token):
+    try:
+        payload = token.split(".")[1]
+        claims = json.loads(base64.urlsafe_b64decode(payload + "=" * (-len(payload) % 4)))
+    except (IndexError, ValueError):
+        return None
+    if claims.get("exp", 0) < time.time():
+        return None
+    return claims.get("username")
+
+
+class DeviceApi:
+    """In-memory API state shared by the request handler threads."""
+
+    def __init__(self, state, sync=True, batch=True, keepalive=True, bulk=True, cursors=True):
+        self.state = state
+        self.cursors = cursors
+        self.sync = sync
+        self.batch = batch
+        self.keepalive = keepalive
+        self.bulk = bulk
+        self.heartbeats = {"full": 0, "keepalive": 0}
+        # UDP heartbeats: devices by id, their HMAC keys and the last (time, sequence) seen
+        self.devices_by_id = {device["id"]: device for device in self.state["devices"]}
+        self.udp_keys = {}
+        self.udp_last = {}
+        self.lock = threading.Lock()
+        # Notified when a command is queued or changed, to answer the waiting long-polls
+        self.commands_changed = threading.Condition(self.lock)
+        # Change sequence: the number of the last change to each row, used as the cursor
+        self.sequence = 0
+        self.row_sequence = {}
+        for collection in ("commands", "files"):
+            for row in self.state[collection]:
+                self.touch(collection, row)
+
+    def touch(self, collection, row):
+        self.sequence += 1
+        self.row_sequence[(collection, row["id"])] = self.sequence
+
+    def changes(self, collection, cursor, pending=False):
+        """Rows changed after cursor ("" = all), oldest change first, with their sequence."""
+        after = int(cursor) if cursor else 0
+        rows = [(self.row_sequence[(collection, row["id"])], row) for row in self.state[collection]]
+        if pending:
+            rows = [(sequence, row) for sequence, row in rows if self.is_pending(collection, row)]
+        return sorted((entry for entry in rows if entry[0] > after), key=lambda entry: entry[0])
+
+    def limit_offset_page(self, collection, query, url):
+        """A page of the full list as DRF's LimitOffsetPagination returns it (no cursor)."""
+        limit, offset = int(query["limit"]), int(query.get("offset", 0))
+        with self.lock:
+            rows = list(self.state[collection])
+        link = lambda start: f"{url}?{urllib.parse.urlencode({'limit': limit, 'offset': start})}"
+        return {
+            "count": len(rows),
+            "next": link(offset + limit) if offset + limit < len(rows) else None,
+            "previous": link(max(0, offset - limit)) if offset else None,
+            "results": rows[offset:offset + limit],
+        }
+
+    def page(self, collection, cursor, limit, pending, url):
+        with self.lock:
+            changes = self.changes(collection, cursor, pending)
+            rows = [row for _, row in changes[:limit]]
+            if len(changes) > limit:
+                next_cursor = str(changes[limit - 1][0])
+                query = urllib.parse.urlencode({"cursor": next_cursor, "limit": limit, **({"pending": 1} if pending else {})})
+                return {"results": rows, "next": f"{url}?{query}", "cursor": next_cursor}
+            return {"results": rows, "next": None, "cursor": str(self.sequence)}
+
+    def device(self, serial_number):
+        for device in self.state["devices"]:
+            if device["serial_number"] == serial_number:
+                return device
+        return None
+
+    def login(self, username, password):
+        device = self.device(username)
+        if device is None or device["mlb_serial_number"] != password:
+            return None
+        return {"access": make_token(username, ACCESS_TOKEN_LIFETIME), "refresh": make_token(username, REFRESH_TOKEN_LIFETIME)}
+
+    def v2ray_links(self):
+        return [
+            {"server_list": item["server_list"], "v2ray_link": self.state["server_lists"].get(str(item["server_list"]))}
+            for item in self.state["v2ray"]
+        ]
+
+    def sync_reply(self, device, cursors=None):
+        reply = {
+            "device": device["id"],
+            "device_status": device["device_status"],
+            "commands": self.state["commands"],
+            "files": self.state["files"],
+            "v2ray": self.v2ray_links(),
+        }
+        if cursors is not None:
+            with self.lock:
+                for collection in ("commands", "files"):
+                    cursor = cursors.get(collection) or ""
+                    reply[collection] = [row for _, row in self.changes(collection, cursor, pending=not cursor)]
+                reply["cursors"] = {"commands": str(self.sequence), "files": str(self.sequence)}
+        # UDP heartbeats are acked with ACK_SYNC until the device has synced this state
+        device["synced_sequence"] = self.sequence
+        return reply
+
+    def is_pending(self, collection, row):
+        today = datetime.date.today().isoformat()
+        if collection == "commands":
+            return row["command_status"] and not row["command_has_been_applied"] and row["command_valid_until"] >= today
+        return row["file_status"] and not row["file_has_been_updated"] and row["file_valid_until"] >= today
+
+    def wait_for_commands(self, wait, cursor=None):
+        """Hold until a command is pending (or, with a cursor, changed) or wait seconds pass."""
+        with self.commands_changed:
+            if cursor is None:
+                ready = lambda: any(self.is_pending("commands", row) for row in self.state["commands"])
+            else:
+                ready = lambda: self.changes("commands", cursor, pending=not cursor)
+            self.commands_changed.wait_for(ready, timeout=wait)
+
+    def queue_command(self, command_text):
+        with self.commands_changed:
+            command = {
+                "id": max((command["id"] for command in self.state["commands"]), default=0) + 1,
+                "command_text": command_text,
+                "command_status": True,
+                "command_valid_until": "2099-01-01",
+                "command_has_been_applied": False,
+                "command_response": None,
+                "queued_at": time.time(),
+            }
+            self.state["commands"].append(command)
+            self.touch("commands", command)
+            self.commands_changed.notify_all()
+            return command
+
+    def patch(self, collection, item_id, data):
+        with self.lock:
+            for item in self.state[collection]:
+                if item["id"] == item_id:
+                    item.update(data)
+                    self.touch(collection, item)
+                    self.commands_changed.notify_all()
+                    if item.get("queued_at") and item.get("command_has_been_applied"):
+                        print(f"Command {item_id} applied {time.time() - item['queued_at']:.3f}s after it was queued")
+                    return item
+        return None
+
+
+    def heartbeat(self, device, data):
+        """Record a heartbeat: a keepalive only renews last_seen, a full one also the state."""
+        with self.lock:
+            device["last_seen"] = time.time()
+            if data.get("keepalive"):
+                self.heartbeats["keepalive"] += 1
+            else:
+                self.heartbeats["full"] += 1
+                device["vpn_status"] = data.get("vpn_status")
+
+    def udp_heartbeat(self, packet):
+        """Ack flags for a valid heartbeat datagram (recorded like an HTTPS heartbeat), or None."""
+        fields = udp_heartbeat.unpack(packet)
+        if fields is None or fields[0] != udp_heartbeat.KIND_HEARTBEAT:
+            return None
+        kind, flags, device_id, sequence, timestamp = fields
+        device = self.devices_by_id.get(device_id)
+        if device is None:
+            return None
+        key = self.udp_keys.get(device_id)
+        if key is None:
+            key = self.udp_keys[device_id] = udp_heartbeat.device_key(device["serial_number"], device["mlb_serial_number"])
+        if not udp_heartbeat.verify(packet, key) or abs(timestamp - time.time()) > udp_heartbeat.UDP_MAX_CLOCK_SKEW:
+            return None
+        # Replayed or reordered datagrams are dropped (a resent one is acked again)
+        if (timestamp, sequence) < self.udp_last.get(device_id, (0, 0)):
+            return None
+        self.udp_last[device_id] = (timestamp, sequence)
+        self.heartbeat(device, {"keepalive": bool(flags & udp_heartbeat.FLAG_KEEPALIVE), "vpn_status": bool(flags & udp_heartbeat.FLAG_VPN)})
+        ack_flags = udp_heartbeat.ACK_SYNC if self.sequence > device.get("synced_sequence", -1) else 0
+        return udp_heartbeat.pack(udp_heartbeat.KIND_ACK, ack_flags, device_id, sequence, time.time(), key)
+
+    def node_latency(self, device, nodes):
+        with self.lock:
+            device["node_latency"] = nodes
+        print(f"Node latencies from device {device['id']}: " + ", ".join(
+            f"{node.get('address')}:{node.get('port')}={node.get('latency_ms')}" for node in nodes))
+
+    def apply_batch(self, device, items):
+        """Apply the spooled uploads of a device-batch request; return how many were accepted."""
+        accepted = 0
+        for item in items:
+            if item.get("type") in ("command", "file"):
+                if self.patch(item["type"] + "s", item.get("id"), item.get("data") or {}) is None:
+                    continue
+            elif item.get("type") == "online":
+                device.setdefault("heartbeats", []).append([item.get("time"), (item.get("data") or {}).get("vpn_status")])
+            elif item.get("type") == "update":
+                device["updated_at"] = item.get("time")
+            else:
+                continue
+            accepted += 1
+        print(f"Batch from device {device['id']}: {accepted} of {len(items)} items accepted")
+        return accepted
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    api = None
+    delay = 0
+    files_dir = None
+    files_sent = {"requests": 0, "not_modified": 0, "bytes": 0}
+    files_lock = threading.Lock()
+
+    def log_message(self, format, *args):
+        print(f"{self.address_string()} {format % args}")
+
+    def send_json(self, status, data, headers=None):
+        body = json.dumps(data).encode()
+        if self.delay:
+            time.sleep(self.delay)
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_body(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        if self.headers.get("Content-Type", "").startswith("application/json"):
+            return json.loads(body or b"{}")
+        return {key: values[0] for key, values in urllib.parse.parse_qs(body.decode()).items()}
+
+    def send_file(self, name):
+        try:
+            with open(os.path.join(self.files_dir, os.path.basename(name)), "rb") as file:
+                content = file.read()
+        except OSError:
+            return self.send_json(404, {"detail": "Not found."})
+        etag = '"' + hashlib.sha256(content).hexdigest()[:32] + '"'
+        not_modified = self.headers.get("If-None-Match") == etag
+        with self.files_lock:
+            self.files_sent["requests"] += 1
+            self.files_sent["not_modified" if not_modified else "bytes"] += 1 if not_modified else len(content)
+        self.send_response(304 if not_modified else 200)
+        self.send_header("ETag", etag)
+        self.send_header("Content-Length", "0" if not_modified else str(len(content)))
+        self.end_headers()
+        if not not_modified:
+            self.wfile.write(content)
+
+    def authenticated_device(self):
+        authorization = self.headers.get("Authorization", "")
+        username = read_token(authorization[7:]) if authorization.startswith("Bearer ") else None
+        device = self.api.device(username) if username else None
+        if device is None:
+            self.send_json(401, {"detail": "Authentication credentials were not provided or are invalid."})
+        return device
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        query = dict(urllib.parse.parse_qsl(url.query, keep_blank_values=True))
+        if self.files_dir and url.path.startswith("/files/"):
+            return self.send_file(url.path[len("/files/"):])
+        if self.authenticated_device() is None:
+            return
+
+        if url.path == "/api/devices/":
+            device = self.api.device(query.get("serial_number"))
+            return self.send_json(200, [device] if device else [])
+        match = re.fullmatch(r"/api/device-(command|file)/", url.path)
+        if match:
+            collection = match.group(1) + "s"
+            headers = {}
+            if "wait" in query and collection == "commands":
+                wait = min(float(query["wait"]), MAX_LONG_POLL_WAIT)
+                self.api.wait_for_commands(wait, query.get("cursor"))
+                headers["X-Long-Poll"] = str(int(wait))
+            if not self.api.cursors and "limit" in query:
+                return self.send_json(200, self.api.limit_offset_page(collection, query, f"http://{self.headers.get('Host')}{url.path}"), headers)
+            if "cursor" not in query:
+                return self.send_json(200, self.api.state[collection], headers)
+            page_url = f"http://{self.headers.get('Host')}{url.path}"
+            page = self.api.page(collection, query["cursor"], int(query.get("limit", 100)), query.get("pending") == "1", page_url)
+            return self.send_json(200, page, headers)
+        if url.path == "/api/device-v2ray/":
+            return self.send_json(200, self.api.state["v2ray"])
+        if url.path == "/api/server-list/" and "id__in" in query and self.api.bulk:
+            ids = [server_list_id for server_list_id in query["id__in"].split(",") if server_list_id in self.api.state["server_lists"]]
+            return self.send_json(200, [{"id": int(server_list_id), "v2ray_link": self.api.state["server_lists"][server_list_id]} for server_list_id in ids])
+        match = re.fullmatch(r"/api/server-list/(\d+)/", url.path)
+        if match and match.group(1) in self.api.state["server_lists"]:
+            return self.send_json(200, {"id": int(match.group(1)), "v2ray_link": self.api.state["server_lists"][match.group(1)]})
+        self.send_json(404, {"detail": "Not found."})
+
+    def do_POST(self):
+        path = urllib.parse.urlsplit(self.path).path
+        data = self.read_body()
+
+        if path == "/api/token/":
+            tokens = self.api.login(data.get("username"), data.get("password"))
+            if tokens is None:
+                return self.send_json(401, {"detail": "No active account found with the given credentials"})
+            return self.send_json(200, tokens)
+        if path == "/api/token/refresh/":
+            username = read_token(data.get("refresh", ""))
+            if username is None:
+                return self.send_json(401, {"detail": "Token is invalid or expired"})
+            return self.send_json(200, {"access": make_token(username, ACCESS_TOKEN_LIFETIME)})
+
+        device = self.authenticated_device()
+        if device is None:
+            return
+        if path in ("/api/device-online/", "/api/device-update/", "/api/device-sync/"):
+            if path == "/api/device-sync/" and not self.api.sync:
+                return self.send_json(404, {"detail": "Not found."})
+            if data.get("device") != device["id"]:
+                return self.send_json(400, {"device": [f"Invalid pk \"{data.get('device')}\" - object does not exist."]})
+            if path == "/api/device-update/":
+                return self.send_json(201, data)
+            if data.get("keepalive") and not self.api.keepalive:
+                return self.send_json(400, {"serial_number": ["This field is required."]})
+            self.api.heartbeat(device, data)
+            if path == "/api/device-sync/":
+                return self.send_json(200, self.api.sync_reply(device, data.get("cursors")))
+            return self.send_json(201, data)
+        if path == "/api/device-batch/" and self.api.batch:
+            if data.get("device") != device["id"]:
+                return self.send_json(400, {"device": [f"Invalid pk \"{data.get('device')}\" - object does not exist."]})
+            return self.send_json(200, {"accepted": self.api.apply_batch(device, data.get("items") or [])})
+        if path == "/api/node-latency/":
+            self.api.node_latency(device, data.get("nodes") or [])
+            return self.send_json(201, data)
+        if path == "/api/device-command/":
+            return self.send_json(201, self.api.queue_command(data["command_text"]))
+        self.send_json(404, {"detail": "Not found."})
+
+    def do_PATCH(self):
+        path = urllib.parse.urlsplit(self.path).path
+        data = self.read_body()
+        if self.authenticated_device() is None:
+            return
+
+        match = re.fullmatch(r"/api/device-(command|file)/(\d+)/", path)
+        item = match and self.api.patch(match.group(1) + "s", int(match.group(2)), data)
+        if not item:
+            return self.send_json(404, {"detail": "Not found."})
+        self.send_json(200, item)
+
+
+def serve_udp_heartbeats(api, sock):
+    """Answer the UDP heartbeats received on sock with their acks, until the socket is closed."""
+    while True:
+        try:
+            packet, address = sock.recvfrom(64)
+        except OSError:
+            return
+        ack = api.udp_heartbeat(packet)
+        if ack is not None:
+            sock.sendto(ack, address)
+
+
+def udp_flood(host, port, packets, start):
+    """Benchmark sender: wait for start, then send the prepared datagrams as fast as possible."""
+    import socket
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        start.wait()
+        for packet in packets:
+            sock.sendto(packet, (host, port))
+
+
+def udp_bench(host, devices=1000, per_device=200, senders=2):
+    """Measure the heartbeats per second one receiver thread validates and acks."""
+    import multiprocessing
+    import socket
+
+    state = dict(DEFAULT_STATE, devices=[
+        {"id": i, "serial_number": f"SN{i}", "mlb_serial_number": f"MLB{i}", "device_status": True} for i in range(1, devices + 1)
+    ])
+    api = DeviceApi(state)
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 8 * 1024 * 1024)
+    sock.bind((host, 0))
+    port = sock.getsockname()[1]
+
+    now = time.time()
+    keys = {i: udp_heartbeat.device_key(f"SN{i}", f"MLB{i}") for i in range(1, devices + 1)}
+    packets = [
+        udp_heartbeat.pack(udp_heartbeat.KIND_HEARTBEAT, udp_heartbeat.FLAG_VPN, i, sequence, now, keys[i])
+        for sequence in range(1, per_device + 1) for i in range(1, devices + 1)
+    ]
+    start = multiprocessing.Event()
+    processes = [multiprocessing.Process(target=udp_flood, args=(host, port, packets[n::senders], start)) for n in range(senders)]
+    for process in processes:
+        process.start()
+
+    handled = 0
+    sock.settimeout(1)
+    start.set()
+    began = None
+    while True:
+        try:
+            packet, address = sock.recvfrom(64)
+        except socket.timeout:
+            break
+        if began is None:
+            began = time.perf_counter()
+        ack = api.udp_heartbeat(packet)
+        if ack is not None:
+            sock.sendto(ack, address)
+            handled += 1
+        last = time.perf_counter()
+    for process in processes:
+        process.join()
+    sock.close()
+    if began is None:
+        print("No datagrams received.")
+        return
+    elapsed = last - began
+    print(f"{handled} of {len(packets)} heartbeats acked in {elapsed:.2f}s: {handled / elapsed:.0f} per second "
+          f"({len(packets) - handled} dropped by the socket buffer)")
+
+
+def update_bench(host):
+    """Run update_checker.update_files() for a device directory against the files of this
+    checkout served from /files/, and print the requests, body bytes and files written per run."""
+    import contextlib
+    import io
+    import shutil
+    import tempfile
+    import update_checker
+    from api_client import ValidatorCache
+
+    checkout = os.path.dirname(os.path.abspath(__file__))
+    work = tempfile.mkdtemp()
+    published = os.path.join(work, "published")
+    device = os.path.join(work, "device")
+    os.makedirs(published)
+    os.makedirs(device)
+    names = [os.path.basename(url) for url in update_checker.REMOTE_URLS]
+    for name in names:
+        shutil.copy(os.path.join(checkout, name), published)
+    with contextlib.redirect_stdout(io.StringIO()):
+        update_checker.write_manifest(published)
+
+    Handler.api = DeviceApi(DEFAULT_STATE)
+    Handler.files_dir = published
+    server = ThreadingHTTPServer((host, 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base = f"http://{host}:{server.server_address[1]}/files/"
+
+    # Point the updater at the stand-in and the device directory
+    update_checker.REMOTE_URLS = [base + name for name in names]
+    update_checker.LOCAL_PATHS = [os.path.join(device, name) for name in names]
+    update_checker.MANIFEST_URL = base + "manifest.json"
+    update_checker.SHARED_MODULES_URL = base
+    update_checker.MANIFEST_CACHE_PATH = os.path.join(device, ".update_manifest.json")
+    update_checker.HASH_INDEX_PATH = os.path.join(device, ".update_hash_index.json")
+    update_checker.BUNDLE_PATH = os.path.join(device, update_checker.BUNDLE_NAME)
+    update_checker.BUNDLE_FLAG = os.path.join(device, "agent.bundle")
+    update_checker.BUNDLE_HASH_PATH = update_checker.BUNDLE_PATH + ".sha256"
+    validators = ValidatorCache(os.path.join(device, "http_validators.json"))
+
+    def snapshot():
+        return {name: os.stat(os.path.join(device, name)).st_mtime_ns for name in os.listdir(device)}
+
+    def run(label):
+        sent = dict(Handler.files_sent)
+        before = snapshot()
+        with contextlib.redirect_stdout(io.StringIO()):
+            update_checker.update_files(validators)
+        after = snapshot()
+        written = sum(1 for name in after if before.get(name) != after[name])
+        counts = {key: Handler.files_sent[key] - sent[key] for key in sent}
+        print(f"{label:<38} {counts['requests']:>3} requests {counts['not_modified']:>3} x 304 "
+              f"{counts['bytes']:>8} body bytes {written:>3} files written")
+
+    try:
+        run("first run (empty device)")
+        run("nothing changed")
+        os.remove(os.path.join(device, "online.py"))
+        run("online.py deleted locally")
+        with open(os.path.join(device, "api_client.py"), "a") as file:
+            file.write("# damaged\n")
+        run("api_client.py damaged locally")
+        with open(os.path.join(published, "online.py"), "a") as file:
+            file.write("# new version\n")
+        with contextlib.redirect_stdout(io.StringIO()):
+            update_checker.write_manifest(published)
+        run("new online.py published")
+        run("nothing changed")
+        os.remove(update_checker.MANIFEST_CACHE_PATH)
+        run("stored manifest deleted")
+        open(update_checker.BUNDLE_FLAG, "w").close()
+        run("bundle enabled")
+        run("bundle, nothing changed")
+        os.remove(update_checker.BUNDLE_PATH)
+        run("bundle deleted locally")
+    finally:
+        server.shutdown()
+        shutil.rmtree(work)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local stand-in for the device API.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--state", help="JSON file with the initial state (default: DEFAULT_STATE)")
+    parser.add_argument("--no-sync", action="store_true", help="answer 404 to /api/device-sync/ like an older server")
+    parser.add_argument("--no-batch", action="store_true", help="answer 404 to /api/device-batch/ like an older server")
+    parser.add_argument("--no-keepalive", action="store_true", help="answer 400 to keepalive heartbeats like an older server")
+    parser.add_argument("--no-bulk", action="store_true", help="answer 404 to /api/server-list/?id__in= like an older server")
+    parser.add_argument("--no-cursors", action="store_true", help="page lists by limit/offset without a cursor, like DRF's LimitOffsetPagination")
+    parser.add_argument("--delay", type=float, default=0, help="seconds to hold every reply (injected latency)")
+    parser.add_argument("--udp-port", type=int, help="also receive UDP heartbeats (see udp_heartbeat) on this port")
+    parser.add_argument("--files", help="serve the files of this directory under /files/")
+    parser.add_argument("--update-bench", action="store_true", help="measure what update_checker runs cost against --files, then exit")
+    parser.add_argument("--udp-bench", action="store_true", help="measure the UDP heartbeats per second the receiver takes, then exit")
+    args = parser.parse_args()
+
+    state = DEFAULT_STATE
+    if args.state:
+        with open(args.state, "r") as state_file:
+            state = json.load(state_file)
+
+    if args.udp_bench:
+        return udp_bench(args.host)
+    if args.update_bench:
+        return update_bench(args.host)
+
+    Handler.api = DeviceApi(state, sync=not args.no_sync, batch=not args.no_batch, keepalive=not args.no_keepalive,
+                            bulk=not args.no_bulk, cursors=not args.no_cursors)
+    Handler.delay = args.delay
+    Handler.files_dir = args.files
+    if args.udp_port:
+        import socket
+        udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        udp_socket.bind((args.host, args.udp_port))
+        threading.Thread(target=serve_udp_heartbeats, args=(Handler.api, udp_socket), daemon=True).start()
+        print(f"Receiving UDP heartbeats on {args.host}:{args.udp_port}")
+    server = ThreadingHTTPServer((args.host, args.port), Handler)
+    print(f"Serving the device API on http://{args.host}:{args.port}/api/")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,58 +1,45 @@
 from datetime import datetime
+import fcntl
+import json
 import os
-import requests
 import shutil
 import re
+import time
 import urllib.parse
 import subprocess
+from api_client import ApiClient, RequestException, device_command_list, jittered
+from device_sync import sync_recent
+from identity import get_serial_numbers
+from upload_spool import retryable, spool_upload
 
-# File path for storing serial numbers
-SERIAL_FILE_PATH = "/root/serial_numbers.txt"
+# Serializes command execution between the listener, device-sync and the hourly poll
+COMMAND_LOCK_FILE = "/var/run/run_command.lock"
 
-# File path for storing server location
-SERVER_LOCATION_FILE = "/root/server_location.txt"
+# Output of recently executed commands by id. A command the server still lists as pending
+# (its report failed, or a stale list raced another run) is reported again, never re-run.
+APPLIED_COMMANDS_PATH = "/root/applied_commands.json"
+APPLIED_COMMANDS_KEPT = 50
 
+# The server holds a long-poll this many seconds before answering with an empty list
+LONG_POLL_WAIT = 55
 
-# Step 1: Obtain the token
-def get_token(api_url, username, password):
-    token_endpoint = f"{api_url}/api/token/"
-    payload = {
-        "username": username,
-        "password": password
-    }
-    try:
-        response = requests.post(token_endpoint, data=payload)
-        response.raise_for_status()
-        token_data = response.json()
-        return token_data.get("access")  # Return the access token
-    except requests.exceptions.RequestException as e:
-        print(f"Error obtaining token: {e}")
-        return None
+# Pause after a failed poll, or one answered at once with nothing new to run
+LISTEN_RETRY_DELAY = 30
 
 
-# Step 2: Fetch the device-v2ray information
-def get_device_command(api_url, token):
-    device_command_endpoint = f"{api_url}/api/device-command/"
-    headers = {
-        "Authorization": f"Bearer {token}"
-    }
+# Step 1: Fetch the pending commands (only the changes since the last call, if supported)
+def get_device_command(client):
     try:
-        response = requests.get(device_command_endpoint, headers=headers)
-        response.raise_for_status()
-        return response.json()
-    except requests.exceptions.RequestException as e:
+        rows, _ = device_command_list().fetch(client)
+        return rows
+    except (RequestException, ValueError, KeyError) as e:
         print(f"Error fetching device-command data: {e}")
         return None
 
 
 # Function to update the database
-def update_database(api_url, token, file_id, command_response):
+def update_database(client, file_id, command_response):
     try:
-        update_endpoint = f"{api_url}/api/device-command/{file_id}/"
-        headers = {
-            "Authorization": f"Bearer {token}",
-            "Content-Type": "application/json"
-        }
         update_data = {
             "command_has_been_applied": True,
             "command_response": command_response,
@@ -60,54 +47,44 @@ def update_database(api_url, token, file_id, command_response):
         }
 
         # Send PATCH request to update the database
-        update_response = requests.patch(update_endpoint, headers=headers, json=update_data)
+        update_response = client.update_device_command(file_id, update_data)
         print("Response sent to server")
         update_response.raise_for_status()  # Raise error if request fails
 
+    except RequestException as e:
+        print(f"Failed to update database: {e}")
+        if retryable(e):
+            spool_upload("command", update_data, file_id)
     except Exception as e:
         print(f"Failed to update database: {e}")
 
 
-# Function to read the server base URL from the file
-def get_base_url():
-    if os.path.exists(SERVER_LOCATION_FILE):
-        try:
-            with open(SERVER_LOCATION_FILE, 'r') as file:
-                base_url = file.readline().strip()
-                if base_url:  # Ensure the URL is not empty
-                    return base_url.rstrip('/') + '/'  # Ensure it ends with a slash
-        except Exception as e:
-            print(f"Error reading server location file: {e}")
-    print("Server location file not found or invalid. Exiting.")
-    exit()
-
-
-# Function to read serial numbers from file
-def read_serial_numbers_from_file():
-    if os.path.exists(SERIAL_FILE_PATH):
-        try:
-            with open(SERIAL_FILE_PATH, 'r') as file:
-                lines = file.readlines()
-                if len(lines) == 2:
-                    return lines[0].strip(), lines[1].strip()  # Return both serials
-        except Exception as e:
-            print(f"Error reading from file: {e}")
-    return None, None
-
-
-# Main script execution
-if __name__ == "__main__":
-    api_url = get_base_url()
-
-    # Extract serial numbers
-    serial_number, mlb_serial_number = read_serial_numbers_from_file()
+def load_applied_commands():
+    try:
+        with open(APPLIED_COMMANDS_PATH, 'r') as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}
 
-    username = serial_number
-    password = mlb_serial_number
 
-    token = get_token(api_url, username, password)
-    if token:
-        device_command_data = get_device_command(api_url, token)
+def save_applied_commands(applied):
+    try:
+        # JSON keeps insertion order: drop the oldest entries
+        applied = dict(list(applied.items())[-APPLIED_COMMANDS_KEPT:])
+        with open(APPLIED_COMMANDS_PATH + ".tmp", 'w') as file:
+            json.dump(applied, file)
+        os.replace(APPLIED_COMMANDS_PATH + ".tmp", APPLIED_COMMANDS_PATH)
+    except OSError as e:
+        print(f"Error writing applied commands: {e}")
+
+
+# Run the pending commands and report their output (also called with device-sync replies).
+# Returns the number of commands executed.
+def apply_commands(client, device_command_data):
+    executed = 0
+    with open(COMMAND_LOCK_FILE, 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        applied = load_applied_commands()
 
         for command in device_command_data:
             current_date = datetime.now().date()
@@ -115,16 +92,82 @@ if __name__ == "__main__":
 
             # Check condition
             if command['command_status'] and valid_until >= current_date and not command['command_has_been_applied']:
+                command_id = str(command['id'])
+                if command_id in applied:
+                    print(f"Command {command_id} already executed. Reporting its result again.")
+                    update_database(client, command['id'], applied[command_id])
+                    continue
+
                 command_text = command['command_text']
                 print(f"Command: {command_text}")
 
-                result = subprocess.run(command_text, shell=True, capture_output=True, text=True, check=True)
-                result_text = result.stdout
+                try:
+                    result = subprocess.run(command_text, shell=True, capture_output=True, text=True, check=True)
+                    result_text = result.stdout
+                except subprocess.CalledProcessError as e:
+                    # Report the failure instead of running the command again on every poll
+                    result_text = f"[exit status {e.returncode}] {e.stdout}{e.stderr}"
                 if result_text == '':
                     result_text = '[without result]'
-                update_database(api_url, token, command['id'], result_text)
+                applied[command_id] = result_text
+                save_applied_commands(applied)
+                executed += 1
+                update_database(client, command['id'], result_text)
+    return executed
+
+
+# Long-poll device-command and run each command as soon as it is queued. Returns when
+# stop (a threading.Event) is set, or when the server does not hold the request (no
+# X-Long-Poll header); the hourly poll covers it then.
+def listen(client, serial_number, mlb_serial_number, stop=None):
+    while not (stop and stop.is_set()):
+        started = time.monotonic()
+        try:
+            if not client.get_token(serial_number, mlb_serial_number):
+                raise RequestException("Failed to obtain token.")
+            commands = device_command_list()
+            cursor = commands.cursor(client.server_url)
+            rows, response = commands.fetch(client, wait=LONG_POLL_WAIT)
+            if response.headers.get("X-Long-Poll") is None:
+                print("Server does not support long polling for commands. Using the hourly poll.")
+                return
+            apply_commands(client, rows)
+            # Any change counts, even one that only reports our own PATCH of the last command:
+            # wait for the next change right away instead of backing off
+            changed = commands.cursor(client.server_url) != cursor
+        except (RequestException, ValueError, KeyError) as e:
+            print(f"Error waiting for commands: {e}")
+            changed = False
+
+        # An error, or an empty reply well before the wait was over: do not poll in a tight loop
+        if not changed and time.monotonic() - started < LONG_POLL_WAIT / 2:
+            if stop:
+                stop.wait(jittered(LISTEN_RETRY_DELAY))
+            else:
+                time.sleep(jittered(LISTEN_RETRY_DELAY))
+
+
+# Main script execution
+def main(client=None):
+    if sync_recent():
+        print("Commands are delivered by device-sync. Skipping.")
+        return
 
+    client = client or ApiClient()
 
+    # Read the stored serial numbers, extracting them from the device on first run
+    serial_number, mlb_serial_number = get_serial_numbers()
 
-else:
-    print("Failed to obtain token.")
+    username = serial_number
+    password = mlb_serial_number
+
+    token = client.get_token(username, password)
+    if token:
+        device_command_data = get_device_command(client)
+        apply_commands(client, device_command_data or [])
+    else:
+        print("Failed to obtain token.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,223 @@
+import os
+import re
+
+# A statement of up to three plain or single-quoted words (a quoted value may span lines):
+# almost every statement in a config. Others (escapes, double quotes) go through TOKEN.
+STATEMENT = re.compile(
+    r"[ \t]*(?:(\w+)[ \t]+('[^']*'|[^\s'\"\\#]+)(?:[ \t]+('[^']*'|[^\s'\"\\#]+))?[ \t]*)?(?:#[^\n]*)?(?:\n|\Z)"
+)
+
+# A run of plain `option name 'value'` lines, taken in one go inside a section
+OPTION_LINE = re.compile(r"[ \t]*option[ \t]+([\w-]+)[ \t]+'([^']*)'[ \t]*(?:\n|\Z)")
+OPTION_RUN = re.compile(r"(?:[ \t]*option[ \t]+[\w-]+[ \t]+'[^']*'[ \t]*(?:\n|\Z))+")
+
+# Words are made of adjacent unquoted, '...' and "..." parts: 'it'\''s' is it's.
+# A # starting a word begins a comment.
+TOKEN = re.compile(
+    r"""[ \t\r]+|\\\n|#[^\n]*|\n|(?P<word>(?:[^\s'"\\#]|\\.|'[^']*'|"(?:[^"\\]|\\.)*")"""
+    r"""(?:[^\s'"\\]|\\.|'[^']*'|"(?:[^"\\]|\\.)*")*)""",
+    re.S,
+)
+WORD_PART = re.compile(r"""'([^']*)'|"((?:[^"\\]|\\.)*)"|((?:[^'"\\]|\\.)+)""", re.S)
+ESCAPE = re.compile(r"\\(.)", re.S)
+
+
+def unquote(word):
+    if word[:1] == "'" and word[-1:] == "'" and "'" not in word[1:-1]:
+        return word[1:-1]
+    if not re.search(r"""['"\\]""", word):
+        return word
+    value = []
+    for single, double, bare in WORD_PART.findall(word):
+        if double or bare:
+            # A backslash escapes the next character; before a line break it joins the lines
+            value.append(ESCAPE.sub(lambda m: "" if m.group(1) == "\n" else m.group(1), double or bare))
+        else:
+            value.append(single)
+    return "".join(value)
+
+
+def quote(value):
+    return "'" + value.replace("'", "'\\''") + "'"
+
+
+def line_number(text, position):
+    return text.count("\n", 0, position) + 1
+
+
+def read_statement(text, position):
+    """Words of the statement at position and the position after it."""
+    words = []
+    while position < len(text):
+        match = TOKEN.match(text, position)
+        if match is None:
+            raise ValueError(f"Line {line_number(text, position)}: unterminated quote or escape")
+        position = match.end()
+        if match.group("word") is not None:
+            words.append(unquote(match.group("word")))
+        elif match.group() == "\n":
+            break
+    return words, position
+
+
+class UciSection:
+    """One config section: options map names to a string (option) or a list (list)."""
+
+    __slots__ = ("type", "name", "options")
+
+    def __init__(self, section_type, name=None):
+        self.type = section_type
+        self.name = name  # None for an anonymous section
+        self.options = {}
+
+    def get(self, option, default=None):
+        return self.options.get(option, default)
+
+    def set(self, option, value):
+        # Keeps the option at its place; a new one goes last
+        self.options[option] = list(value) if isinstance(value, (list, tuple)) else str(value)
+
+    def delete(self, option):
+        self.options.pop(option, None)
+
+
+class UciConfig:
+    """Sections of a UCI config file (such as /etc/config/passwall2), indexed by name and type.
+
+    Edits change sections and options in place, keeping their order. save() writes the file
+    in the layout `uci commit` uses, atomically, and only when that output changes; like
+    `uci commit` it does not keep comments.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.package = None
+        self.section_list = []
+        self.by_name = {}
+        self.by_type = {}
+        self.saved_text = None
+
+    @classmethod
+    def load(cls, path):
+        config = cls(path)
+        with open(path, "r", encoding="utf-8") as file:
+            config.parse(file.read())
+        config.saved_text = config.serialize()
+        return config
+
+    def parse(self, text):
+        section = None
+        position = 0
+        match_statement = STATEMENT.match
+        while position < len(text):
+            if section is not None:
+                run = OPTION_RUN.match(text, position)
+                if run is not None:
+                    section.options.update(OPTION_LINE.findall(text, position, run.end()))
+                    position = run.end()
+                    continue
+            start = position
+            match = match_statement(text, position)
+            if match is not None:
+                keyword, name, value = match.groups()
+                position = match.end()
+                if name is not None and name[0] == "'":
+                    name = name[1:-1]
+                if value is not None and value[0] == "'":
+                    value = value[1:-1]
+            else:
+                words, position = read_statement(text, position)
+                if len(words) > 3:
+                    raise ValueError(f"Line {line_number(text, start)}: too many words")
+                keyword, name, value = words + [None] * (3 - len(words))
+
+            if keyword == "option" or keyword == "list":
+                if section is None:
+                    raise ValueError(f"Line {line_number(text, start)}: {keyword} outside a section")
+                if value is None:
+                    raise ValueError(f"Line {line_number(text, start)}: expected {keyword} <name> <value>")
+                if keyword == "option":
+                    section.options[name] = value
+                else:
+                    current = section.options.get(name)
+                    if isinstance(current, list):
+                        current.append(value)
+                    else:
+                        section.options[name] = [value]
+            elif keyword == "config":
+                if name is None:
+                    raise ValueError(f"Line {line_number(text, start)}: expected config <type> [<name>]")
+                # Like uci, a section name seen again adds to the existing section
+                section = self.section(value) if value is not None else None
+                if section is None or section.type != name:
+                    section = self.add(name, value)
+            elif keyword == "package":
+                self.package = name
+            elif keyword is not None:
+                raise ValueError(f"Line {line_number(text, start)}: unknown statement '{keyword}'")
+
+    def section(self, name):
+        return self.by_name.get(name)
+
+    def sections(self, section_type=None):
+        if section_type is None:
+            return list(self.section_list)
+        return list(self.by_type.get(section_type, ()))
+
+    def add(self, section_type, name=None):
+        """Append a new section; a named one replaces any section of that name."""
+        if name is not None and name in self.by_name:
+            self.remove(name)
+        section = UciSection(section_type, name)
+        self.section_list.append(section)
+        self.by_type.setdefault(section_type, []).append(section)
+        if name is not None:
+            self.by_name[name] = section
+        return section
+
+    def set_section(self, section_type, name, options):
+        """Give the named section exactly these options, in place if it exists (else appended)."""
+        section = self.section(name)
+        if section is None or section.type != section_type:
+            section = self.add(section_type, name)
+        section.options = {}
+        for option, value in options.items():
+            section.set(option, value)
+        return section
+
+    def remove(self, name):
+        section = self.by_name.pop(name, None)
+        if section is not None:
+            self.section_list.remove(section)
+            self.by_type[section.type].remove(section)
+        return section
+
+    def serialize(self):
+        out = [f"package {quote(self.package)}\n"] if self.package else []
+        for section in self.section_list:
+            out.append(f"\nconfig {section.type} {quote(section.name)}\n" if section.name is not None else f"\nconfig {section.type}\n")
+            for option, value in section.options.items():
+                if isinstance(value, list):
+                    out.extend(f"\tlist {option} {quote(item)}\n" for item in value)
+                else:
+                    out.append(f"\toption {option} {quote(value)}\n")
+        return "".join(out)
+
+    def save(self, path=None):
+        """Write the config if its output changed since it was loaded or saved; True if written."""
+        path = path or self.path
+        text = self.serialize()
+        if text == self.saved_text and path == self.path:
+            return False
+        temp_path = path + ".tmp"
+        with open(temp_path, "w", encoding="utf-8") as file:
+            file.write(text)
+            file.flush()
+            # A power loss right after the rename must not leave an empty config behind
+            os.fsync(file.fileno())
+        if os.path.exists(path):
+            os.chmod(temp_path, os.stat(path).st_mode & 0o7777)
+        os.replace(temp_path, path)
+        self.path = path
+        self.saved_text = text
+        return True
@@ -0,0 +1,135 @@
+import hashlib
+import hmac
+import json
+import os
+import socket
+import struct
+import time
+
+# "host:port" of the server's UDP heartbeat receiver; without this file online.py uses HTTPS only
+UDP_TARGET_FILE = "/root/heartbeat_udp.txt"
+
+# Sequence number and last failure; on tmpfs, since it changes on every heartbeat
+UDP_STATE_PATH = "/tmp/heartbeat_udp.json"
+
+# Seconds to wait for the ack of each datagram, and datagrams sent before falling back to HTTPS
+UDP_ACK_TIMEOUT = 1.5
+UDP_ATTEMPTS = 2
+
+# After a heartbeat went unacknowledged, use HTTPS only for this long
+UDP_RECHECK_INTERVAL = 3600
+
+# Receivers drop packets whose time is further than this from their clock
+UDP_MAX_CLOCK_SKEW = 300
+
+# Packet: kind, flags, device id, sequence number, unix time, then a truncated HMAC-SHA256 of
+# those 14 bytes. Acks echo the device id and sequence number with kind KIND_ACK.
+PACKET_HEADER = struct.Struct("!BBIII")
+MAC_SIZE = 16
+PACKET_SIZE = PACKET_HEADER.size + MAC_SIZE
+
+KIND_HEARTBEAT = 1
+KIND_ACK = 0x81
+
+# Heartbeat flags
+FLAG_VPN = 0x01
+FLAG_KEEPALIVE = 0x02  # State unchanged since the last full heartbeat
+
+# Ack flags
+ACK_SYNC = 0x01  # The server has changes for the device: run device-sync over HTTPS
+
+
+def device_key(serial_number, mlb_serial_number):
+    """HMAC key of a device, derived from the credentials the server already holds."""
+    return hashlib.sha256(f"{serial_number}:{mlb_serial_number}".encode()).digest()
+
+
+def packet_device_id(device_id):
+    """device_id as the packet's unsigned 32-bit field; None if it does not fit (a UUID, a
+    string that is not a number...), and the device then sends its heartbeats over HTTPS."""
+    if isinstance(device_id, str) and device_id.isdigit():
+        device_id = int(device_id)
+    if type(device_id) is not int or not 0 <= device_id <= 0xFFFFFFFF:
+        return None
+    return device_id
+
+
+def pack(kind, flags, device_id, sequence, timestamp, key):
+    header = PACKET_HEADER.pack(kind, flags, device_id, sequence & 0xFFFFFFFF, int(timestamp) & 0xFFFFFFFF)
+    return header + hmac.new(key, header, hashlib.sha256).digest()[:MAC_SIZE]
+
+
+def unpack(packet):
+    """(kind, flags, device_id, sequence, timestamp) of a packet, not yet authenticated; None if malformed."""
+    if len(packet) != PACKET_SIZE:
+        return None
+    return PACKET_HEADER.unpack(packet[:PACKET_HEADER.size])
+
+
+def verify(packet, key):
+    mac = hmac.new(key, packet[:PACKET_HEADER.size], hashlib.sha256).digest()[:MAC_SIZE]
+    return hmac.compare_digest(mac, packet[PACKET_HEADER.size:])
+
+
+def load_target():
+    """(host, port) from UDP_TARGET_FILE, or None when the UDP transport is not configured."""
+    try:
+        with open(UDP_TARGET_FILE, 'r') as target_file:
+            host, _, port = target_file.readline().strip().rpartition(":")
+        return host.strip("[]"), int(port)
+    except (OSError, ValueError):
+        return None
+
+
+def load_state():
+    try:
+        with open(UDP_STATE_PATH, 'r') as state_file:
+            return json.load(state_file)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_state(state):
+    try:
+        with open(UDP_STATE_PATH + ".tmp", 'w') as state_file:
+            json.dump(state, state_file)
+        os.replace(UDP_STATE_PATH + ".tmp", UDP_STATE_PATH)
+    except OSError as e:
+        print(f"Error writing UDP heartbeat state: {e}")
+
+
+def send_heartbeat(target, device_id, flags, key):
+    """Send one heartbeat datagram and wait for its ack; return the ack flags, or None when
+    no valid ack arrived (and then skip UDP for UDP_RECHECK_INTERVAL)."""
+    state = load_state()
+    if state.get("failed_at", 0) + UDP_RECHECK_INTERVAL > time.time():
+        return None
+    # Receivers expect (time, sequence) to grow: the counter may restart after a reboot
+    state["sequence"] = (state.get("sequence", 0) + 1) & 0xFFFFFFFF
+    save_state(state)
+    packet = pack(KIND_HEARTBEAT, flags, device_id, state["sequence"], time.time(), key)
+
+    try:
+        family, kind, proto, _, address = socket.getaddrinfo(target[0], target[1], type=socket.SOCK_DGRAM)[0]
+        with socket.socket(family, kind, proto) as sock:
+            # Connected: datagrams from any other address are not delivered to us
+            sock.connect(address)
+            sock.settimeout(UDP_ACK_TIMEOUT)
+            for _ in range(UDP_ATTEMPTS):
+                sock.send(packet)
+                deadline = time.monotonic() + UDP_ACK_TIMEOUT
+                while time.monotonic() < deadline:
+                    try:
+                        reply = sock.recv(64)
+                    except socket.timeout:
+                        break
+                    fields = unpack(reply)
+                    if (fields and fields[0] == KIND_ACK and fields[2:4] == (device_id, state["sequence"])
+                            and verify(reply, key)):
+                        return fields[1]
+    except OSError as e:
+        print(f"Error sending UDP heartbeat: {e}")
+
+    state["failed_at"] = time.time()
+    save_state(state)
+    return None
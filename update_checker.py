@@ -1,37 +1,129 @@
 import shutil
 import hashlib
-from datetime import datetime
-import requests
+import importlib.util
 import json
-import subprocess
-import re
+import marshal
+import sys
+import zipfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
 import os
-import time
+import urllib.request
+
+# Shared modules imported below. A router updated by an older update_checker.py that did
+# not list them yet, or left with a stale copy by an interrupted update, would otherwise fail
+# here forever, so on an ImportError all of them are fetched again first.
+SHARED_MODULES_URL = "https://raw.githubusercontent.com/behjaf/google/main/"
+SHARED_MODULES = ["http_transport.py", "api_client.py", "identity.py", "agent.py", "upload_spool.py"]
+
+
+def bootstrap_shared_modules():
+    directory = os.path.dirname(os.path.abspath(__file__))
+    print("[!] Shared modules are missing or out of date. Downloading them...")
+    # Download every module before replacing any, so a failure leaves the old set in place
+    staged = []
+    for name in SHARED_MODULES:
+        module_path = os.path.join(directory, name)
+        with urllib.request.urlopen(SHARED_MODULES_URL + name, timeout=30) as response:
+            content = response.read()
+        with open(module_path + ".tmp", "wb") as module_file:
+            module_file.write(content)
+        staged.append(module_path)
+    for module_path in staged:
+        os.replace(module_path + ".tmp", module_path)
+        # Import the new copy, not the one that failed part way
+        sys.modules.pop(os.path.basename(module_path)[:-3], None)
+
+
+try:
+    from api_client import ApiClient, RequestException, ValidatorCache, get_session
+    from identity import get_serial_numbers
+    from agent import SCHEDULE, job_offsets, schedule_seed
+    from upload_spool import retryable, spool_upload
+except ImportError:
+    bootstrap_shared_modules()
+    from api_client import ApiClient, RequestException, ValidatorCache, get_session
+    from identity import get_serial_numbers
+    from agent import SCHEDULE, job_offsets, schedule_seed
+    from upload_spool import retryable, spool_upload
 
 # Configuration
-REMOTE_URLS = [  # List of 5 remote URLs
+REMOTE_URLS = [  # List of remote URLs (shared modules first, so scripts never run without them)
+    "https://raw.githubusercontent.com/behjaf/google/main/http_transport.py",
+    "https://raw.githubusercontent.com/behjaf/google/main/api_client.py",
+    "https://raw.githubusercontent.com/behjaf/google/main/identity.py",
+    "https://raw.githubusercontent.com/behjaf/google/main/agent.py",
+    "https://raw.githubusercontent.com/behjaf/google/main/device_sync.py",
+    "https://raw.githubusercontent.com/behjaf/google/main/upload_spool.py",
+    "https://raw.githubusercontent.com/behjaf/google/main/udp_heartbeat.py",
+    "https://raw.githubusercontent.com/behjaf/google/main/led_status.py",
     "https://raw.githubusercontent.com/behjaf/google/main/led_status.sh",
     "https://raw.githubusercontent.com/behjaf/google/main/online.py",
     "https://raw.githubusercontent.com/behjaf/google/main/validate_router.py",
     "https://raw.githubusercontent.com/behjaf/google/main/get_server_address.py",
+    "https://raw.githubusercontent.com/behjaf/google/main/uci.py",
     "https://raw.githubusercontent.com/behjaf/google/main/get_new_v2ray.py",
     "https://raw.githubusercontent.com/behjaf/google/main/update_checker.py",
     "https://raw.githubusercontent.com/behjaf/google/main/file_get.py",
     "https://raw.githubusercontent.com/behjaf/google/main/run_command.py",
+    "https://raw.githubusercontent.com/behjaf/google/main/command_listener.py",
     "https://raw.githubusercontent.com/behjaf/google/main/change_link.py",
 ]  # Replace with your own URLs
 LOCAL_PATHS = [
+    "/root/http_transport.py",
+    "/root/api_client.py",
+    "/root/identity.py",
+    "/root/agent.py",
+    "/root/device_sync.py",
+    "/root/upload_spool.py",
+    "/root/udp_heartbeat.py",
+    "/root/led_status.py",
     "/root/led_status.sh",
     "/root/online.py",
     "/root/validate_router.py",
     "/root/get_server_address.py",
+    "/root/uci.py",
     "/root/get_new_v2ray.py",
     "/root/update_checker.py",
     "/root/file_get.py",
     "/root/run_command.py",
+    "/root/command_listener.py",
     "/root/change_link.py",
 ]  # Corresponding local file paths
 
+# Files downloaded in parallel; api_client.MAX_CONNECTIONS_PER_HOST also caps each host
+UPDATE_WORKERS = 4
+
+# Downloads are streamed to disk in chunks of this size
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+# Hash manifest published next to the files: {"files": {"online.py": "<sha256>", ...}}
+MANIFEST_URL = "https://raw.githubusercontent.com/behjaf/google/main/manifest.json"
+
+# Last manifest fetched: a 304 checks the local files against it, so a deleted or damaged
+# file is restored without waiting for the next publish
+MANIFEST_CACHE_PATH = "/root/.update_manifest.json"
+
+# Local file hashes keyed on (mtime, size), so unchanged files are not hashed again
+HASH_INDEX_PATH = "/root/.update_hash_index.json"
+
+# Single-file deployment: every file above in one zipapp, listed in the manifest as "bundle".
+# Routers switch to it when BUNDLE_FLAG exists (see agent.bundle_enabled).
+BUNDLE_NAME = "agent.pyz"
+BUNDLE_PATH = "/root/agent.pyz"
+BUNDLE_FLAG = "/root/agent.bundle"
+# SHA256 of the published bundle the installed one was built from
+BUNDLE_HASH_PATH = "/root/agent.pyz.sha256"
+
+# Entry point of the bundle: python3 agent.pyz <job> runs <job>.main(), without a job the daemon
+BUNDLE_MAIN = """\
+import importlib
+import sys
+
+job = sys.argv[1] if len(sys.argv) > 1 else "agent"
+importlib.import_module(job).main()
+"""
+
 
 def calculate_file_hash(file_path):
     """Calculate the SHA256 hash of a local file."""
@@ -46,55 +138,376 @@ def calculate_file_hash(file_path):
         return None
 
 
-def get_remote_file_hash(url):
-    """Download the remote file and calculate its hash."""
+def get_remote_file_hash(url, temp_path, validators=None):
+    """Stream the remote file into temp_path, hashing each chunk as it is written.
+
+    Memory use does not depend on the file size. Returns the SHA256 of the fsynced
+    temp file, or None on errors and on a 304 to a conditional request (validators).
+    """
     try:
         # Force no-cache by setting headers
-        response = requests.get(url, stream=True, headers={"Cache-Control": "no-cache"})
-        response.raise_for_status()
-
-        remote_content = b""
-        sha256 = hashlib.sha256()
-        for chunk in response.iter_content(chunk_size=4096):
-            remote_content += chunk
-            sha256.update(chunk)
-
-        return sha256.hexdigest(), remote_content
-    except requests.RequestException as e:
+        headers = {"Cache-Control": "no-cache"}
+        if validators:
+            headers.update(validators.headers(url))
+        # Closed on every path, so an unread 304 or error body does not keep its connection
+        with get_session().get(url, stream=True, headers=headers, timeout=(5, 30)) as response:
+            response.raise_for_status()
+            if response.status_code == 304:
+                print(f"Remote file unchanged: {url}")
+                return None
+
+            sha256 = hashlib.sha256()
+            with open(temp_path, "wb") as temp_file:
+                for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                    sha256.update(chunk)
+                    temp_file.write(chunk)
+                temp_file.flush()
+                os.fsync(temp_file.fileno())
+
+        if validators:
+            validators.remember(url, response)
+        return sha256.hexdigest()
+    except (RequestException, OSError) as e:
         print(f"Error fetching remote file: {e}")
-        return None, None
+        discard_file(temp_path)
+        return None
 
 
-def update_local_file(local_path, new_content):
-    """Replace the local file with the new content and make it executable."""
+def discard_file(path):
     try:
-        temp_path = local_path + ".tmp"
-        with open(temp_path, "wb") as temp_file:
-            temp_file.write(new_content)
-        shutil.move(temp_path, local_path)
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
 
-        # Make the file executable
-        os.chmod(local_path, 0o755)  # rwxr-xr-x
+def update_local_file(local_path, temp_path):
+    """Atomically replace the local file with the downloaded temp file and make it executable."""
+    try:
+        os.chmod(temp_path, 0o755)  # rwxr-xr-x
+        os.replace(temp_path, local_path)
 
         print(f"[*] Local file {local_path} has been updated and made executable at {datetime.now()}")
+        return True
     except Exception as e:
         print(f"Error updating local file {local_path}: {e}")
+        discard_file(temp_path)
+        return False
+
+
+def load_hash_index():
+    try:
+        with open(HASH_INDEX_PATH, "r") as index_file:
+            return json.load(index_file)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_hash_index(index):
+    try:
+        temp_path = HASH_INDEX_PATH + ".tmp"
+        with open(temp_path, "w") as index_file:
+            json.dump(index, index_file)
+        os.replace(temp_path, HASH_INDEX_PATH)
+    except OSError as e:
+        print(f"Error writing hash index: {e}")
+
+
+def indexed_file_hash(file_path, index):
+    """Return the SHA256 of a local file, re-hashing it only if its mtime or size changed."""
+    try:
+        stat = os.stat(file_path)
+    except FileNotFoundError:
+        print(f"Local file not found: {file_path}")
+        return None
+    entry = index.get(file_path)
+    if entry and entry[0] == stat.st_mtime_ns and entry[1] == stat.st_size:
+        return entry[2]
+    file_hash = calculate_file_hash(file_path)
+    if file_hash:
+        index[file_path] = [stat.st_mtime_ns, stat.st_size, file_hash]
+    return file_hash
+
+
+def load_manifest():
+    try:
+        with open(MANIFEST_CACHE_PATH, "r") as manifest_file:
+            manifest = json.load(manifest_file)
+        if isinstance(manifest.get("files"), dict):
+            return manifest
+    except (OSError, ValueError, AttributeError):
+        pass
+    return None
+
+
+def save_manifest(manifest):
+    try:
+        with open(MANIFEST_CACHE_PATH + ".tmp", "w") as manifest_file:
+            json.dump(manifest, manifest_file)
+        os.replace(MANIFEST_CACHE_PATH + ".tmp", MANIFEST_CACHE_PATH)
+    except OSError as e:
+        print(f"Error writing {MANIFEST_CACHE_PATH}: {e}")
+
+
+def fetch_manifest(validators):
+    """Conditionally fetch the manifest; return the response (304 if unchanged) or None."""
+    try:
+        headers = {"Cache-Control": "no-cache"}
+        headers.update(validators.headers(MANIFEST_URL))
+        response = get_session().get(MANIFEST_URL, headers=headers, timeout=(5, 30))
+        response.raise_for_status()
+        if response.status_code != 304 and not isinstance(response.json().get("files"), dict):
+            raise ValueError("manifest has no files mapping")
+        return response
+    except (RequestException, ValueError, AttributeError) as e:
+        print(f"Error fetching update manifest: {e}")
+        return None
+
+
+def apply_updates(staged):
+    """Move every downloaded (temp_path, local_path) into place, or none if any step fails."""
+    backups = []
+    try:
+        for temp_path, local_path in staged:
+            os.chmod(temp_path, 0o755)  # rwxr-xr-x
+            if os.path.exists(local_path):
+                shutil.copy2(local_path, local_path + ".bak")
+                backups.append(local_path)
+            os.replace(temp_path, local_path)
+            print(f"[*] Local file {local_path} has been updated and made executable at {datetime.now()}")
+    except Exception as e:
+        print(f"Error applying updates, rolling back: {e}")
+        for local_path in backups:
+            os.replace(local_path + ".bak", local_path)
+        for temp_path, local_path in staged:
+            discard_file(temp_path)
+            if local_path not in backups and os.path.exists(local_path):
+                os.remove(local_path)
+        return False
+
+    for local_path in backups:
+        os.remove(local_path + ".bak")
+    return True
+
+
+def download_files(downloads, validators=None):
+    """Fetch (remote_url, temp_path, local_path) items in parallel, yielding each as it finishes.
+
+    Yields (remote_url, temp_path, local_path, remote_hash) in completion order, so hashing
+    and comparison overlap with the remaining downloads.
+    """
+    with ThreadPoolExecutor(max_workers=UPDATE_WORKERS) as pool:
+        futures = {
+            pool.submit(get_remote_file_hash, remote_url, temp_path, validators): (remote_url, temp_path, local_path)
+            for remote_url, temp_path, local_path in downloads
+        }
+        try:
+            for future in as_completed(futures):
+                yield futures[future] + (future.result(),)
+        finally:
+            # The caller stopped early: drop downloads that have not started yet
+            for future in futures:
+                future.cancel()
+
+
+def update_from_manifest(manifest):
+    """Download only the files whose manifest hash differs and apply them as one transaction."""
+    index = load_hash_index()
+    loaded_index = dict(index)
+    downloads = []
+    for remote_url, local_path in zip(REMOTE_URLS, LOCAL_PATHS):
+        expected_hash = manifest.get(os.path.basename(remote_url))
+        if expected_hash and indexed_file_hash(local_path, index) != expected_hash:
+            print(f"Update detected for {local_path}. Downloading...")
+            downloads.append((remote_url, local_path + ".new", local_path))
+
+    staged = []
+    results = download_files(downloads)
+    for remote_url, temp_path, local_path, remote_hash in results:
+        if remote_hash != manifest[os.path.basename(remote_url)]:
+            print(f"Downloaded {remote_url} does not match the manifest. Aborting update.")
+            break
+        staged.append((temp_path, local_path))
+    # Wait for downloads still in flight before cleaning up their temp files
+    results.close()
+
+    if len(staged) != len(downloads):
+        for _, temp_path, _ in downloads:
+            discard_file(temp_path)
+        if index != loaded_index:
+            save_hash_index(index)
+        return False
+
+    applied = not staged or apply_updates(staged)
+    if staged and applied:
+        for _, local_path in staged:
+            indexed_file_hash(local_path, index)
+    # Nothing changed (the usual run): no write to flash
+    if index != loaded_index:
+        save_hash_index(index)
+    return applied
+
+
+def update_files_individually(validators):
+    """Fallback without a manifest: fetch every changed file and compare it with the local copy."""
+    downloads = [(remote_url, local_path + ".tmp", local_path) for remote_url, local_path in zip(REMOTE_URLS, LOCAL_PATHS)]
+    for remote_url, temp_path, local_path, remote_hash in download_files(downloads, validators):
+        if remote_hash:
+            local_hash = calculate_file_hash(local_path)
+            if local_hash != remote_hash:
+                print(f"Update detected for {local_path}. Updating local file...")
+                if not update_local_file(local_path, temp_path):
+                    # Download again next run instead of getting a 304
+                    validators.forget(remote_url)
+            else:
+                discard_file(temp_path)
+
+
+def build_bundle(directory, files):
+    """Write the agent.pyz zipapp for the files in REMOTE_URLS; return its version.
+
+    The archive is reproducible (fixed timestamps and order), so it only changes along with
+    its content. It holds sources; routers compile them for their own interpreter on install.
+    """
+    version = hashlib.sha256(json.dumps(files, sort_keys=True).encode()).hexdigest()[:12]
+    entries = [(name, open(os.path.join(directory, name), "rb").read()) for name in sorted(files)]
+    entries += [("__main__.py", BUNDLE_MAIN.encode()), ("VERSION", f"{version}\n".encode())]
+
+    with zipfile.ZipFile(os.path.join(directory, BUNDLE_NAME), "w") as bundle:
+        for name, content in entries:
+            info = zipfile.ZipInfo(name, date_time=(1980, 1, 1, 0, 0, 0))
+            info.compress_type = zipfile.ZIP_DEFLATED
+            info.external_attr = 0o755 << 16
+            bundle.writestr(info, content)
+    return version
+
+
+def write_manifest(directory):
+    """Write manifest.json and agent.pyz for the files in REMOTE_URLS from a checkout in directory."""
+    files = {}
+    for remote_url in REMOTE_URLS:
+        name = os.path.basename(remote_url)
+        files[name] = calculate_file_hash(os.path.join(directory, name))
+    version = build_bundle(directory, files)
+    bundle = {
+        "name": BUNDLE_NAME,
+        "sha256": calculate_file_hash(os.path.join(directory, BUNDLE_NAME)),
+        "version": version,
+    }
+    with open(os.path.join(directory, "manifest.json"), "w") as manifest_file:
+        json.dump({"bundle": bundle, "files": files}, manifest_file, indent=4, sort_keys=True)
+        manifest_file.write("\n")
+
+
+def compile_sourceless(source, filename):
+    """Return .pyc bytes for this interpreter that zipimport loads without the source."""
+    code = compile(source, filename, "exec", dont_inherit=True)
+    # Header: magic, flags (0 = timestamp based), source mtime, source size
+    header = importlib.util.MAGIC_NUMBER + (0).to_bytes(4, "little") * 2 + (len(source) & 0xFFFFFFFF).to_bytes(4, "little")
+    return header + marshal.dumps(code)
+
+
+def install_bundle(temp_path):
+    """Install a downloaded bundle as BUNDLE_PATH with precompiled bytecode only.
+
+    Shell scripts (led_status.sh) are extracted next to it.
+    """
+    directory = os.path.dirname(BUNDLE_PATH)
+    new_path = BUNDLE_PATH + ".new"
+    try:
+        with zipfile.ZipFile(temp_path) as source, zipfile.ZipFile(new_path, "w", zipfile.ZIP_DEFLATED) as bundle:
+            for info in source.infolist():
+                content = source.read(info)
+                if info.filename.endswith(".py"):
+                    name = info.filename[:-3] + ".pyc"
+                    bundle.writestr(name, compile_sourceless(content, os.path.join(BUNDLE_PATH, info.filename)))
+                else:
+                    bundle.writestr(info.filename, content)
+                    if info.filename.endswith(".sh"):
+                        script_path = os.path.join(directory, info.filename)
+                        with open(script_path + ".new", "wb") as script_file:
+                            script_file.write(content)
+                        os.chmod(script_path + ".new", 0o755)
+                        os.replace(script_path + ".new", script_path)
+            version = source.read("VERSION").decode().strip()
+        os.replace(new_path, BUNDLE_PATH)
+        print(f"[*] Bundle {BUNDLE_PATH} version {version} installed at {datetime.now()}")
+        return True
+    except Exception as e:
+        print(f"Error installing bundle: {e}")
+        discard_file(new_path)
+        return False
+    finally:
+        discard_file(temp_path)
+
+
+def update_bundle(bundle):
+    """Download and install the manifest's bundle unless it is already installed."""
+    try:
+        with open(BUNDLE_HASH_PATH, "r") as hash_file:
+            installed_hash = hash_file.read().strip()
+    except OSError:
+        installed_hash = None
+    if installed_hash == bundle["sha256"] and os.path.exists(BUNDLE_PATH):
+        print(f"[*] Bundle version {bundle['version']} is already installed.")
+        return True
+
+    print(f"Update detected for {BUNDLE_PATH}. Downloading version {bundle['version']}...")
+    temp_path = BUNDLE_PATH + ".download"
+    remote_hash = get_remote_file_hash(SHARED_MODULES_URL + bundle["name"], temp_path)
+    if remote_hash != bundle["sha256"]:
+        print("Downloaded bundle does not match the manifest. Aborting update.")
+        discard_file(temp_path)
+        return False
+    if not install_bundle(temp_path):
+        return False
+
+    with open(BUNDLE_HASH_PATH + ".tmp", "w") as hash_file:
+        hash_file.write(remote_hash)
+    os.replace(BUNDLE_HASH_PATH + ".tmp", BUNDLE_HASH_PATH)
+    return True
+
+
+# The agent daemon runs every job itself; cron only restarts it if it is not running
+AGENT_PATH = "/root/agent.py"
+AGENT_DISABLED_FLAG = "/root/agent.disabled"
+
+
+def job_cron_command(job, bundle):
+    if bundle:
+        return f"/usr/bin/python3 {BUNDLE_PATH} {job}"
+    return f"/usr/bin/python3 /root/{job}.py"
+
+
+def cron_entry(minute, hour, offset, command):
+    """Crontab line for a SCHEDULE entry, shifted by this device's offset (agent.job_offset)."""
+    minutes, seconds = divmod(offset, 60)
+    if minute.startswith("*/"):
+        minute = f"{minutes}-59/{minute[2:]}"
+    else:
+        minute = str((int(minute) + minutes) % 60)
+    if seconds:
+        # cron has no seconds field
+        command = f"sleep {seconds}; {command}"
+    return f"{minute} {hour} * * * {command}\n"
+
+
+def desired_crontab():
+    """Daemon watchdog if the agent is available, else one interpreter per job (agent.SCHEDULE)."""
+    bundle = os.path.exists(BUNDLE_FLAG) and os.path.exists(BUNDLE_PATH)
+    if os.path.exists(AGENT_DISABLED_FLAG) or not (bundle or os.path.exists(AGENT_PATH)):
+        offsets = job_offsets(schedule_seed())
+        return "".join(cron_entry(minute, hour, offsets[job], job_cron_command(job, bundle)) for minute, hour, job in SCHEDULE)
+
+    # Started unconditionally: a running daemon holds agent.AGENT_LOCK_FILE, so the new copy
+    # exits at once. (pgrep -f would always match the cron shell's own command line.)
+    # The daemon's output goes to syslog (logread -e agent), which keeps a bounded log
+    return f"*/10 * * * * {job_cron_command('agent', bundle)} 2>&1 | logger -t agent\n"
 
 
 def verify_crontab():
     """Verify and update the crontab file if its content differs from the desired schedule."""
     crontab_path = "/etc/crontabs/root"
-    desired_crontab_content = """\
-*/2 * * * * /root/led_status.sh
-*/5 * * * * /usr/bin/python3 /root/online.py
-0 */11 * * * /usr/bin/python3 /root/validate_router.py
-0 */5 * * * /usr/bin/python3 /root/get_server_address.py
-0 */2 * * * /usr/bin/python3 /root/get_new_v2ray.py
-0 */7 * * * /usr/bin/python3 /root/update_checker.py
-0 */9 * * * /usr/bin/python3 /root/file_get.py
-0 */1 * * * /usr/bin/python3 /root/run_command.py
-*/20 * * * * /usr/bin/python3 /root/change_link.py
-"""
+    desired_crontab_content = desired_crontab()
 
     try:
         # Check if the crontab file exists
@@ -119,130 +532,26 @@ def verify_crontab():
         print(f"Error verifying or updating crontab file: {e}")
 
 
-def sent_update_done_to_server():
-    # File path for storing server location
-    SERVER_LOCATION_FILE = "/root/server_location.txt"
+def sent_update_done_to_server(client=None):
+    # API client on the shared keep-alive session (reads the server location file)
+    client = client or ApiClient()
 
-    # Retry logic
-
-    def retry_request(func, max_retries=5, delay=30):
-        """Retry a request with exponential backoff."""
-        for attempt in range(1, max_retries + 1):
-            try:
-                response = func()
-                if response.ok:  # Covers 2xx responses
-                    return response
-                else:
-                    print(f"Attempt {attempt}/{max_retries}: Failed with status {response.status_code}")
-            except requests.RequestException as e:
-                print(f"Attempt {attempt}/{max_retries}: Exception {e}")
-            time.sleep(delay * (2 ** (attempt - 1)))  # Exponential backoff
-        print("Max retries reached. Exiting.")
-        exit(1)
-
-    # Function to read the server base URL from the file
-    def get_base_url():
-        if os.path.exists(SERVER_LOCATION_FILE):
-            try:
-                with open(SERVER_LOCATION_FILE, 'r') as file:
-                    base_url = file.readline().strip()
-                    if base_url:  # Ensure the URL is not empty
-                        return base_url.rstrip('/') + '/api/'  # Ensure it ends with a slash
-            except Exception as e:
-                print(f"Error reading server location file: {e}")
-        print("Server location file not found or invalid. Exiting.")
-        exit()
-
-    # Read the base URL dynamically
-    BASE_URL = get_base_url()
-    TOKEN_URL = f"{BASE_URL}token/"
-    DEVICE_URL = f"{BASE_URL}devices/"
-    DEVICE_UPDATE_URL = f"{BASE_URL}device-update/"
-
-    # File path for storing serial numbers
-    SERIAL_FILE_PATH = "/root/serial_numbers.txt"
-
-    # Function to extract serial numbers from the file
-    def extract_serial_numbers(file_path):
-        try:
-            result = subprocess.run(["strings", file_path], capture_output=True, text=True)
-            if result.returncode != 0:
-                print("Failed to read the file.")
-                return None, None
-
-            mlb_match = re.search(r"mlb_serial_number\s+([A-Za-z0-9]+)", result.stdout)
-            serial_match = re.search(r"\bserial_number\s+([A-Za-z0-9]+)", result.stdout)
-
-            mlb_serial_number = mlb_match.group(1) if mlb_match else None
-            serial_number = serial_match.group(1) if serial_match else None
-
-            return mlb_serial_number, serial_number
-
-        except Exception as e:
-            print(f"Error extracting serial numbers: {e}")
-            return None, None
-
-    # Function to read serial numbers from file
-    def read_serial_numbers_from_file():
-        if os.path.exists(SERIAL_FILE_PATH):
-            try:
-                with open(SERIAL_FILE_PATH, 'r') as file:
-                    lines = file.readlines()
-                    if len(lines) == 2:
-                        return lines[0].strip(), lines[1].strip()  # Return both serials
-            except Exception as e:
-                print(f"Error reading from file: {e}")
-        return None, None
-
-    # Function to write serial numbers to file
-    def write_serial_numbers_to_file(serial_number, mlb_serial_number):
-        try:
-            with open(SERIAL_FILE_PATH, 'w') as file:
-                file.write(f"{serial_number}\n{mlb_serial_number}\n")
-        except Exception as e:
-            print(f"Error writing to file: {e}")
-
-    # Check if serial numbers file exists, if not extract and save
-    serial_number, mlb_serial_number = read_serial_numbers_from_file()
+    # Read the stored serial numbers, re-extracting them if the nvmem checksum changed
+    serial_number, mlb_serial_number = get_serial_numbers(verify=True)
 
     if not mlb_serial_number or not serial_number:
-        print("Serial numbers not found in file. Extracting from device...")
-        # Path to the file containing the serial numbers
-        file_path = "/sys/devices/platform/soc/78b5000.spi/spi_master/spi0/spi0.0/mtd/mtd0/mtd0/nvmem"
-        mlb_serial_number, serial_number = extract_serial_numbers(file_path)
-
-        if mlb_serial_number and serial_number:
-            print(f"Extracted serial numbers: {serial_number}, {mlb_serial_number}")
-            # Write the extracted serial numbers to the file
-            write_serial_numbers_to_file(serial_number, mlb_serial_number)
-        else:
-            print("Failed to extract serial numbers.")
-            exit()
-
-    # Get token each time the script runs
-    def get_token():
-        return requests.post(TOKEN_URL, data={"username": serial_number, "password": mlb_serial_number})
-
-    response = retry_request(get_token)
-
-    token = response.json()["access"]
-    # print("Token obtained successfully!")
-
-    headers = {
-        "Authorization": f"Bearer {token}",
-        "Content-Type": "application/json",
-    }
-
-    # Fetch device ID using serial_number
-    def fetch_device():
-        return requests.get(DEVICE_URL, headers=headers, params={"serial_number": serial_number})
-
-    device_response = retry_request(fetch_device)
+        exit()
 
-    device_data = device_response.json()
+    # One attempt only: an unreachable server gets the ack with the next heartbeat's upload
+    try:
+        if not client.authenticate(serial_number, mlb_serial_number):
+            raise RequestException("Failed to obtain token.")
 
-    if device_data:
-        device_id = device_data[0]["id"]
+        # Device ID from the stored identity record; /api/devices/ is only queried when it is missing
+        device_id = client.device_id(serial_number)
+        if device_id is None:
+            print(f"No device found for serial number: {serial_number}")
+            return
 
         # Prepare payload for Device_Update
         payload = {
@@ -251,38 +560,74 @@ def sent_update_done_to_server():
             "device": device_id,
         }
 
-        # Post to Device_Online
-        def post_device_update():
-            return requests.post(DEVICE_UPDATE_URL, headers=headers, data=json.dumps(payload))
-
-        online_response = retry_request(post_device_update)
+        response = client.device_update(payload)
+        if response.status_code in (400, 404):
+            # The server rejected the stored device ID: look it up again and resend once
+            payload["device"] = client.device_id(serial_number, refresh=True)
+            if payload["device"] is not None:
+                response = client.device_update(payload)
+        response.raise_for_status()
         print("Device Time update data posted successfully!")
+    except RequestException as e:
+        print(f"Error posting device update: {e}")
+        if retryable(e):
+            spool_upload("update")
+
+
+def apply_manifest(manifest):
+    if os.path.exists(BUNDLE_FLAG) and manifest.get("bundle"):
+        return update_bundle(manifest["bundle"])
+    return update_from_manifest(manifest["files"])
+
+
+def update_files(validators):
+    """Bring the local files (or the bundle) in line with the published manifest."""
+    response = fetch_manifest(validators)
+    manifest = None
+    if response is not None and response.status_code == 304:
+        manifest = load_manifest()
+        if manifest is None:
+            # Stored copy is gone: fetch the full manifest again
+            validators.forget(MANIFEST_URL)
+            response = fetch_manifest(validators)
+    if response is None:
+        update_files_individually(validators)
+    elif response.status_code == 304:
+        # The hash index makes this a stat() per file unless a file changed
+        print("[*] Update manifest unchanged. Checking the local files against it.")
+        apply_manifest(manifest)
     else:
-        print(f"No device found for serial number: {serial_number}")
+        manifest = response.json()
+        save_manifest(manifest)
+        if apply_manifest(manifest):
+            # Only a fully applied manifest may be answered with 304 next time
+            validators.remember(MANIFEST_URL, response)
 
 
-if __name__ == "__main__":
-    for remote_url, local_path in zip(REMOTE_URLS, LOCAL_PATHS):
-        remote_hash, remote_content = get_remote_file_hash(remote_url)
-        if remote_hash:
-            local_hash = calculate_file_hash(local_path)
-            if local_hash != remote_hash:
-                print(f"Update detected for {local_path}. Updating local file...")
-                update_local_file(local_path, remote_content)
-        time.sleep(1)
+def main(client=None):
+    update_files(ValidatorCache())
 
     server_location_path = "/root/server_location.txt"
     if not os.path.exists(server_location_path):
-        print(f"[!] {server_location_path} does not exist. Running get_server_address.py...")
+        print(f"[!] {server_location_path} does not exist. Running get_server_address...")
         try:
-            get_server_address_path = "/root/get_server_address.py"
-            os.system(f"python3 {get_server_address_path}")
+            # In this process, so it also works when running from the bundle
+            import get_server_address
+            get_server_address.main()
             print(f"[*] {server_location_path} created successfully.")
-        except Exception as e:
-            print(f"Error running {get_server_address_path}: {e}")
+        except (Exception, SystemExit) as e:
+            print(f"Error running get_server_address: {e}")
 
     # Verify and update crontab
     verify_crontab()
 
     # Notify server about update completion
-    sent_update_done_to_server()
+    sent_update_done_to_server(client)
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] == ["--write-manifest"]:
+        # Run from a checkout before publishing changes
+        write_manifest(os.path.dirname(os.path.abspath(__file__)))
+    else:
+        main()
@@ -0,0 +1,149 @@
+import fcntl
+import json
+import os
+import time
+from api_client import RequestException
+
+# Uploads that failed while the server was unreachable, one compact JSON object per line:
+# {"type": "online"|"update"|"command"|"file", "time": <epoch>, "id": <row id>, "data": {...}}
+SPOOL_PATH = "/root/upload_spool.jsonl"
+SPOOL_LOCK_FILE = "/var/run/upload_spool.lock"
+
+# Beyond this size the oldest heartbeats are dropped first, then the oldest other entries
+SPOOL_MAX_BYTES = 32 * 1024
+
+# Status codes of a server without the device-batch endpoint
+BATCH_UNSUPPORTED_CODES = (404, 405, 501)
+
+
+def spool_lock():
+    lock_file = open(SPOOL_LOCK_FILE, "w")
+    fcntl.flock(lock_file, fcntl.LOCK_EX)
+    return lock_file
+
+
+def load_entries():
+    entries = []
+    try:
+        with open(SPOOL_PATH, "r") as spool_file:
+            for line in spool_file:
+                try:
+                    entries.append(json.loads(line))
+                except ValueError:
+                    pass  # A line cut short by a power loss
+    except OSError:
+        pass
+    return entries
+
+
+def save_entries(entries):
+    lines = [json.dumps(entry, separators=(",", ":")) + "\n" for entry in entries]
+    size = sum(len(line) for line in lines)
+    for heartbeats_only in (True, False):
+        index = 0
+        while size > SPOOL_MAX_BYTES and index < len(lines):
+            if heartbeats_only and entries[index]["type"] != "online":
+                index += 1
+                continue
+            size -= len(lines[index])
+            del lines[index], entries[index]
+
+    try:
+        if not lines:
+            if os.path.exists(SPOOL_PATH):
+                os.remove(SPOOL_PATH)
+            return
+        with open(SPOOL_PATH + ".tmp", "w") as spool_file:
+            spool_file.writelines(lines)
+        os.replace(SPOOL_PATH + ".tmp", SPOOL_PATH)
+    except OSError as e:
+        print(f"Error writing upload spool: {e}")
+
+
+def spool_pending():
+    return os.path.exists(SPOOL_PATH)
+
+
+def retryable(error):
+    """True for request errors worth spooling: no answer at all, or a server-side failure."""
+    response = getattr(error, "response", None)
+    return response is None or response.status_code >= 500 or response.status_code == 429
+
+
+def spool_upload(kind, data=None, item_id=None):
+    """Keep a failed upload for the next flush. Acks replace an older one for the same item;
+    every heartbeat is kept, with the time it was due."""
+    entry = {"type": kind, "time": int(time.time())}
+    if item_id is not None:
+        entry["id"] = item_id
+    if data is not None:
+        entry["data"] = data
+    line = json.dumps(entry, separators=(",", ":")) + "\n"
+    with spool_lock():
+        size = os.path.getsize(SPOOL_PATH) if os.path.exists(SPOOL_PATH) else 0
+        if kind == "online" and size + len(line) <= SPOOL_MAX_BYTES:
+            # Append instead of rewriting the spool every few minutes on flash storage
+            try:
+                with open(SPOOL_PATH, "a") as spool_file:
+                    spool_file.write(line)
+            except OSError as e:
+                print(f"Error writing upload spool: {e}")
+        else:
+            entries = load_entries()
+            if kind != "online":
+                entries = [old for old in entries if (old["type"], old.get("id")) != (kind, item_id)]
+            entries.append(entry)
+            save_entries(entries)
+    print(f"Queued {kind} upload for when the server is reachable.")
+
+
+def replay(client, device, entries):
+    """Send spooled acks one at a time to a server without device-batch; return the entries
+    done with. Old heartbeats are dropped: the one just accepted supersedes them."""
+    sent = []
+    for entry in entries:
+        try:
+            if entry["type"] == "command":
+                response = client.update_device_command(entry["id"], entry["data"])
+            elif entry["type"] == "file":
+                response = client.update_device_file(entry["id"], entry["data"])
+            elif entry["type"] == "update":
+                response = client.device_update(device)
+            else:
+                sent.append(entry)
+                continue
+            response.raise_for_status()
+        except RequestException as e:
+            if retryable(e):
+                print(f"Error uploading spooled {entry['type']}: {e}")
+                break
+            print(f"Server rejected spooled {entry['type']}: {e}. Dropping it.")
+        sent.append(entry)
+    return sent
+
+
+def flush_spool(client, device):
+    """Upload the spool as one device-batch request after a successful heartbeat.
+
+    device holds the serial_number, mlb_serial_number and device fields of the heartbeat.
+    """
+    with spool_lock():
+        entries = load_entries()
+    if not entries:
+        return
+
+    try:
+        response = client.device_batch(dict(device, items=entries))
+        if response.status_code in BATCH_UNSUPPORTED_CODES:
+            sent = replay(client, device, entries)
+        else:
+            response.raise_for_status()
+            sent = entries
+    except RequestException as e:
+        print(f"Error uploading spooled data: {e}")
+        return
+
+    # Entries spooled meanwhile stay for the next flush
+    with spool_lock():
+        save_entries([entry for entry in load_entries() if entry not in sent])
+    print(f"Uploaded {len(sent)} spooled items.")